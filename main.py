@@ -12,16 +12,21 @@ import click
 from update import check_manifests
 from src.config import ConfigHandler, GLOBAL_CONFIG_FILE, DEFAULT_GLOBAL
 from src.authentication import TwitchOAuth2Helper
-from src.bot import TwitchBot
+from src.bot import TwitchBot, TwitchIRC
+from src.stats import serve_metrics
 
 @click.command()
-@click.option("--channel", help="The Twitch channel to target.")
+@click.option(
+    "--channel",
+    multiple=True,
+    help="The Twitch channel to target. Can be given more than once to join several channels from one connection.",
+)
 @click.option(
     "--authfile",
     help="The path to the auth file. This is relative to the 'userdata' folder.",
 )
-def main(channel=None, authfile=None):
-    tb = None
+def main(channel=(), authfile=None):
+    tirc = None
     try:
         # Check for updates/missing files first!
         check_manifests()
@@ -34,15 +39,20 @@ def main(channel=None, authfile=None):
             authfile = cfg_global["default_authfile"]
         auth = TwitchOAuth2Helper(authfile)
 
-        if not channel:
-            channel = auth.user_id
+        if cfg_global["metrics_port"]:
+            serve_metrics(cfg_global["metrics_port"])
+
+        channels = list(channel) or cfg_global["channels"] or [auth.user_id]
 
-        tb = TwitchBot(auth, channel)
-        tb.start()
+        # every channel shares one chat connection, auth session, and module code
+        tirc = TwitchIRC(auth)
+        for channel_name in channels:
+            TwitchBot(auth, channel_name, irc=tirc)
+        tirc.start()
 
     except KeyboardInterrupt:
-        if isinstance(tb, TwitchBot):
-            tb.__del__()
+        if isinstance(tirc, TwitchIRC):
+            tirc.__del__()
         sys.exit(0)
 
     except:
@@ -5,6 +5,7 @@ import json
 
 from src.plugins import BaseModule
 from src.definitions import Message, NO_MESSAGE_SIGNAL
+from src.stats import stats
 from update import RASBOT_BASE_MANIFEST
 
 
@@ -109,3 +110,40 @@ class Module(BaseModule):
             case "reload":
                 self._bot.reload()
                 return "reloaded"
+
+            case "stats":
+                # only this channel's numbers, plus the shared ones (e.g. http) on the bot's own channel
+                channels = [self._bot.channel_name]
+                if self._bot.channel_name == self._bot.auth.user_id:
+                    channels.append(None)
+
+                if len(args) > 1 and args[1] == "reset":
+                    stats.reset(channels)
+                    return "stats reset"
+
+                snapshot = stats.snapshot(channels)
+                if len(args) > 1:
+                    # match names by prefix; http ones have spaces and upper case in them
+                    prefix = " ".join(args[1:])
+                    snapshot = {
+                        k: v
+                        for k, v in snapshot.items()
+                        if k[1].lower().startswith(prefix)
+                    }
+
+                if not snapshot:
+                    return "no stats recorded"
+
+                # slowest first, by p95
+                slowest = sorted(
+                    snapshot.items(), key=lambda i: i[1][3][1], reverse=True
+                )
+
+                results = []
+                for (kind, name, _), (count, errors, _, quantiles) in slowest[:5]:
+                    p50, p95, p99 = [f"{q * 1000:.0f}ms" for q in quantiles]
+                    results.append(
+                        f"{name} ({kind}): {count}x, p50 {p50} p95 {p95} p99 {p99}, {errors} err"
+                    )
+
+                return " | ".join(results)
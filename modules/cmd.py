@@ -160,7 +160,7 @@ class Module(BaseModule):
                     return "Command name can only use alphanumeric characters and underscores (_)."
 
                 self._bot.commands_handler.add(
-                    new_name, self._bot.commands_handler.commands[cmd_name]
+                    new_name, self._bot.commands_handler.commands[cmd_name].jsonify()
                 )
                 self._bot.commands_handler.delete(cmd_name)
                 self._bot.save()
@@ -219,8 +219,27 @@ class Module(BaseModule):
 
                 return f"Hiding from help for {cmd_name} toggled to {value}."
 
-            return (
-                "Valid fields to modify are: cooldown, response, requires_mod, hidden"
-            )
+            if key in ["alias", "aliases"]:
+                value = [alias.lower() for alias in cmd]
+
+                for alias in value:
+                    if not VALID_COMMAND_RE.match(alias):
+                        return "Aliases can only use alphanumeric characters and underscores (_)."
+
+                    if alias in self._bot.commands_handler.commands:
+                        return f"{alias} is already a command."
+
+                    owner = self._bot.commands_handler.aliases.get(alias, None)
+                    if owner and owner != cmd_name:
+                        return f"{alias} is already an alias of {owner}."
+
+                self._bot.commands_handler.modify(cmd_name, "aliases", value)
+                self._bot.save()
+
+                if not value:
+                    return f"Aliases for {cmd_name} cleared."
+                return f"Aliases for {cmd_name} set to {', '.join(value)}."
+
+            return "Valid fields to modify are: cooldown, response, requires_mod, hidden, aliases"
 
         return "Valid actions are: add, remove, edit."
@@ -39,8 +39,9 @@ class Module(BaseModule):
             name = args[0]
 
             # if the name resolves to a module, give the module's helpmsg
-            if name in self._bot.modules_handler.modules:
-                return self._bot.modules_handler.modules[name].help()
+            # (without creating it, if it's loaded lazily)
+            if self._bot.modules_handler.has(name):
+                return self._bot.modules_handler.get_class(name).help()
 
             # if not a module and resolves to a command...
             elif name in self._bot.commands_handler.commands:
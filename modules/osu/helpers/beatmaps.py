@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import threading
+import time
+
+from src.cache import TTLCache
+
+from modules.osu.helpers.api2 import OsuAPIv2Helper
+
+PERMANENT_STATUSES = {"ranked", "approved", "loved"}
+"""Statuses of maps that can no longer change, and are kept forever."""
+
+UNRANKED_TTL = 60 * 60
+"""How long to keep maps of any other status (pending, graveyard, qualified...), in seconds."""
+
+MEMORY_SIZE = 512
+"""Maximum amount of maps and mapsets to keep in memory."""
+
+
+class BeatmapCache:
+    """Caches osu! beatmap and beatmapset information from the osu! API.
+
+    Lookups go through an in-memory LRU, then an on-disk sqlite store, then the API.
+    Maps that can no longer change are stored forever; anything else expires after `UNRANKED_TTL`.
+    """
+
+    api_helper: OsuAPIv2Helper
+    db_path: str
+
+    def __init__(self, api_helper: OsuAPIv2Helper, db_path: str):
+        """Create a new `BeatmapCache`.
+
+        :param api_helper: The osu! API helper to fetch missing maps with.
+        :param db_path: Path to the sqlite store. Created if it doesn't exist.
+        """
+        self.api_helper = api_helper
+        self.db_path = db_path
+
+        # entries are (expiry, json) so every lookup gets its' own copy to modify
+        self._memory = TTLCache(MEMORY_SIZE)
+
+        # sqlite3 connections can only be used on the thread that made them
+        self._local = threading.local()
+
+        with self.get_db() as db:
+            for table in ("beatmaps", "beatmapsets"):
+                db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY,
+                    data TEXT,
+                    expires REAL
+                )
+                """)
+
+                # forget anything that has expired since last time
+                db.execute(f"DELETE FROM {table} WHERE expires < ?", (time.time(),))
+
+    def get_db(self) -> sqlite3.Connection:
+        """Get the store connection for the current thread, opening it if needed.
+
+        :return: The `sqlite3.Connection` for this thread.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+
+        return db
+
+    def get_beatmap(self, beatmap_id: int) -> dict:
+        """Get information for the beatmap with ID `beatmap_id`. See `OsuAPIv2Helper.get_beatmap`.
+
+        :param beatmap_id: The ID of the beatmap.
+        :return: The beatmap, or `None` if it could not be retrieved.
+        """
+        return self.__get("beatmaps", int(beatmap_id), self.api_helper.get_beatmap)
+
+    def get_beatmapset(self, beatmapset_id: int) -> dict:
+        """Get maps and information for the beatmap set with ID `beatmapset_id`. See `OsuAPIv2Helper.get_beatmapset`.
+
+        :param beatmapset_id: The ID of the beatmap set.
+        :return: The beatmap set, or `None` if it could not be retrieved.
+        """
+        return self.__get(
+            "beatmapsets", int(beatmapset_id), self.api_helper.get_beatmapset
+        )
+
+    def __get(self, table: str, id: int, fetch) -> dict:
+        key = (table, id)
+        loader = lambda: self.__load(table, id, fetch)
+
+        entry = self._memory.get_or_load(key, loader)
+        if entry and entry[0] is not None and entry[0] <= time.time():
+            self._memory.delete(key)
+            entry = self._memory.get_or_load(key, loader)
+
+        if not entry:
+            return None
+
+        return json.loads(entry[1])
+
+    def __load(self, table: str, id: int, fetch) -> tuple:
+        """Load `id` from the store, or from the API if missing or expired.
+
+        :return: (`expiry`, `json`), or `None` if it could not be retrieved.
+        """
+        db = self.get_db()
+        row = db.execute(
+            f"SELECT expires, data FROM {table} WHERE id = ?", (id,)
+        ).fetchone()
+        if row and (row[0] is None or row[0] > time.time()):
+            return row
+
+        data = fetch(id)
+        if not data:
+            # better a stale map than no map
+            return row
+
+        expires = None
+        if str(data.get("status", "")).lower() not in PERMANENT_STATUSES:
+            expires = time.time() + UNRANKED_TTL
+
+        entry = (expires, json.dumps(data))
+        with db:
+            db.execute(
+                f"INSERT OR REPLACE INTO {table} VALUES(?,?,?)", (id, entry[1], expires)
+            )
+
+        return entry
@@ -3,11 +3,18 @@
 # Replace the path in the config file in `userdata/[id]/modules/osu` with the path to the file
 #   (default value is default path for Windows StreamCompanion, might not need to change it)
 # Create a command using cmd with %osu/np% as the response.
+#
+# Other modules can react to song changes with:
+#   self._bot.modules_handler.get("osu/np").on_change(callback)
 
 # TODO: refactor this to use new osu! APIv2 "Now Playing" once it drops
 # will remove dependency on using StreamCompanion
 
+import os
+import threading
+
 from src.plugins import BaseModule
+from src.watch import FileWatcher
 
 
 class Module(BaseModule):
@@ -16,10 +23,81 @@ class Module(BaseModule):
     default_config = {"path": "C:/Program Files (x86)/StreamCompanion/Files/np.txt"}
     """Path to osu!StreamCompanion NP info file."""
 
+    def __init__(self, bot, name):
+        BaseModule.__init__(self, bot, name)
+
+        # the NP line is only re-read when the file changes
+        self.np = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+        # on_change hooks, and the NP line they were last told about
+        self._hooks = []
+        self._watcher = None
+        self._notified = None
+
+    def __del__(self):
+        if self._watcher:
+            self._watcher.stop()
+
+    def get_path(self) -> str:
+        return self.cfg_get("path").replace("\\", "/")
+
+    def now_playing(self) -> str | None:
+        """Get the first line of the NP file, reading it only if it changed since last time.
+
+        :return: The NP line, or `None` if the file is missing or empty.
+        """
+        path = self.get_path()
+
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._signature = None
+                self.np = None
+                return None
+
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature != self._signature:
+                try:
+                    with open(path, "r") as file:
+                        self.np = file.readline().rstrip("\r\n") or None
+                except OSError:
+                    self.np = None
+                self._signature = signature
+
+            return self.np
+
+    def on_change(self, callback):
+        """Call `callback(np)` whenever the NP line changes, until this module is unimported.
+
+        :param callback: Function taking the new NP line (or `None` if there is none).
+        """
+        self._hooks.append(callback)
+
+        # only watch the file once someone is listening
+        if not self._watcher:
+            self._notified = self.now_playing()
+            self._watcher = FileWatcher(self.get_path(), self.__changed)
+            self._watcher.start()
+
+    def __changed(self):
+        np = self.now_playing()
+        if np == self._notified:
+            return
+
+        self._notified = np
+
+        for hook in self._hooks:
+            try:
+                hook(np)
+            except Exception as err:
+                self.log_e(f"NP change hook {hook} failed: {err}")
+
     def main(self, message):
-        try:
-            path = self.cfg_get("path").replace("\\", "/")
-            with open(path, "r") as file:
-                return f"{file.readlines()[0]}"
-        except (FileNotFoundError, IndexError):
+        np = self.now_playing()
+        if not np:
             return "No NP data found."
+
+        return np
@@ -3,10 +3,12 @@
 #   ^ Ctrl+F 'default_config' to find the fields
 # Create a command using cmd with %osu/request% in the response.
 
+from collections import deque
 import irc
 import re
-from threading import Thread
+import threading
 import time
+import traceback
 
 from src.plugins import BaseModule
 from src.definitions import (
@@ -16,10 +18,33 @@ from src.definitions import (
     NO_MESSAGE_SIGNAL,
 )
 
+from src.config import BASE_CONFIG_PATH
+from src.ratelimit import TokenBucket
+from src.template import Template
 from modules.osu.helpers.api2 import OsuAPIv2Helper
+from modules.osu.helpers.beatmaps import BeatmapCache
+
+OSU_LINK_RE = re.compile(
+    r"https?://osu\.ppy\.sh/(?:"
+    r"beatmapsets/(?P<set>\d+)/?(?:#[a-z]+/(?P<map>\d+))?"
+    r"|b(?:eatmaps)?/(?P<b>\d+)"
+    r")(?=\s|$)(?:\s+(?P<mods>\S+))?",
+    re.IGNORECASE,
+)
+"""Finds a beatmap or beatmapset link, and the word after it as mods, anywhere in a message."""
+
+
+def beatmap_key(match: re.Match) -> tuple[str, int]:
+    """Get the map a match of `OSU_LINK_RE` links to.
+
+    :param match: The match.
+    :return: `("beatmap", id)`, or `("beatmapset", id)` if the link doesn't name a difficulty.
+    """
+    if match["map"] or match["b"]:
+        return ("beatmap", int(match["map"] or match["b"]))
+
+    return ("beatmapset", int(match["set"]))
 
-OSU_LONG_RE = r"^https:\/\/osu.ppy.sh\/beatmapsets\/(\d+)\/?(?:#[a-z]+\/(\d+))?$"
-OSU_SHORT_RE = r"^https:\/\/osu.ppy.sh\/b(?:eatmaps)?\/(\d+)$"
 
 # See https://github.com/ppy/osu-api/wiki#response for more info
 OSU_STATUSES = [
@@ -52,7 +77,11 @@ OSU_MODS = [
     "V2",
 ]
 
-MESSAGE_OPT_RE = re.compile(r"(%([\/a-z0-9_]+)%)")
+OSU_IRC_LIMIT = (5, 5)
+"""Messages allowed per seconds to osu! IRC; Bancho silences users who send too quickly."""
+
+QUEUE_DISPLAY_LIMIT = 5
+"""Maximum amount of queued requests to list with `request queue`."""
 
 MESSAGE_OPTIONS = {
     # web
@@ -87,6 +116,28 @@ MESSAGE_OPTIONS = {
 }
 
 
+class QueuedRequest:
+    """A beatmap request waiting to be looked up and sent to osu!."""
+
+    author: Author
+    key: tuple
+    """`("beatmap", id)` or `("beatmapset", id)`."""
+    mods: str
+    notify: bool
+    """Whether to tell the requester in chat if the request fails."""
+    ack: bool
+    """Whether to tell the requester in chat once the request was sent, too."""
+
+    def __init__(
+        self, author: Author, key: tuple, mods: str, notify: bool, ack: bool = False
+    ):
+        self.author = author
+        self.key = key
+        self.mods = mods
+        self.notify = notify
+        self.ack = ack
+
+
 # TODO: replace this with modules.osu.helpers.api2.OsuAPIv2Helper.message_self() once supported by osuAPIv2
 class OsuRequestsIRCBot(irc.bot.SingleServerIRCBot):
     def __init__(self, user, server, port=6667, password=None, log_i=None):
@@ -95,6 +146,23 @@ class OsuRequestsIRCBot(irc.bot.SingleServerIRCBot):
         )
         self.user = user
         self.log_i = log_i
+        self._stopped = False
+
+    def start(self):
+        """Connect and handle events until `stop()` is called."""
+        self._connect()
+        while not self._stopped:
+            self.reactor.process_once(0.2)
+
+    def stop(self):
+        """Disconnect for good, and make `start()` return."""
+        self._stopped = True
+        self.connection.disconnect()
+
+    def _on_disconnect(self, connection, event):
+        # don't reconnect if we meant to leave
+        if not self._stopped:
+            irc.bot.SingleServerIRCBot._on_disconnect(self, connection, event)
 
     def on_welcome(self, c, e):
         self.log_i(f"osu! IRC Connected as {self.user}")
@@ -105,7 +173,8 @@ class OsuRequestsIRCBot(irc.bot.SingleServerIRCBot):
 
 class Module(BaseModule):
     helpmsg = (
-        "Request an osu! beatmap to be played. Usage: request <beatmap link> <+mods?>"
+        "Request an osu! beatmap to be played. Usage: request <beatmap link> <+mods?> / "
+        + "request queue / request clear"
     )
 
     default_config = {
@@ -115,6 +184,7 @@ class Module(BaseModule):
         "osu_irc_pwd": "",
         # The format of the message to send alongside. See MESSAGE_OPTIONS for keys.
         # Enclose keys in % as you would a module in a command.
+        # The same keys can be used in commands as %osu/request:key% for the last request sent.
         "message_format": "%requester% (%requesterstatus%) requested: %map% %mods% (%length% @ %bpm%BPM, %stars%*, by %creator%)",
         # Per-user cooldown for requests (in seconds)
         "cd_per_user": 0,
@@ -122,25 +192,50 @@ class Module(BaseModule):
         "parse_all_messages": True,
         # Whether or not to inform user of requests handled using parse_all_messages.
         "respond_all_messages": True,
+        # Amount of requests to look up and send at once.
+        "request_workers": 2,
+        # Requests for a map that was already requested within this many seconds are ignored.
+        "dedupe_window": 300,
+        # Whether to respond once the map has been looked up and sent, rather than as soon as it is queued.
+        "ack_after_lookup": False,
     }
 
     consumes = 2
 
+    # commands can use any message_format key for the last sent request, e.g. %osu/request:song%
+    template_fields = MESSAGE_OPTIONS
+
+    # only look at messages that could contain a beatmap link
+    on_pubmsg_filter = "osu.ppy.sh/b"
+
     def __init__(self, bot, name):
         BaseModule.__init__(self, bot, name)
 
         # set up
+        self.last_map = None
         self.cooldown = self.cfg_get("cd_per_user")
         self.author_cds = dict()
 
+        # requests are looked up and sent by workers so bursts don't hold up chat
+        self.queue = deque()
+        self.recent = dict()
+        self._queue_cond = threading.Condition()
+        self._closed = False
+
+        # sends to osu! IRC are spaced out to avoid being silenced
+        self._osu_bucket = TokenBucket(*OSU_IRC_LIMIT)
+        self._osu_lock = threading.Lock()
+
         # get api v2 helper
         self.api_helper = OsuAPIv2Helper(
             f"{self._bot.channel_id}/modules/osu/helpers/api2.txt"
         )
 
-        # compile mapID regex
-        self.beatmap_re = re.compile(OSU_LONG_RE)
-        self.b_re = re.compile(OSU_SHORT_RE)
+        # popular maps get requested over and over; only ask the API once
+        self.beatmaps = BeatmapCache(
+            self.api_helper,
+            f"{BASE_CONFIG_PATH}/{self._bot.channel_id}/modules/osu/beatmaps.db",
+        )
 
         # resolve username
         self.username = self.resolve_username(self.cfg_get("osu_trgt_id"))
@@ -154,9 +249,23 @@ class Module(BaseModule):
                 log_i=self.log_i,
             )
 
-            self.osu_irc_bot_thread = Thread(target=self.osu_irc_bot.start)
-            self.osu_irc_bot_thread.daemon = True
-            self.osu_irc_bot_thread.start()
+            self.osu_irc_bot_thread = self.start_thread(
+                self.osu_irc_bot.start, stop=self.osu_irc_bot.stop
+            )
+
+            for _ in range(self.cfg_get("request_workers")):
+                self.start_thread(self.work)
+
+    def __del__(self):
+        # stop workers and answer anyone still waiting
+        with self._queue_cond:
+            self._closed = True
+            self.__clear_queue("Requests are closed.")
+            self._queue_cond.notify_all()
+
+        # the next instance gets its' own helper; stop this one refreshing the token
+        if hasattr(self, "api_helper"):
+            self.api_helper.close()
 
     def resolve_username(self, id: (str | int)) -> str | None:
         """Resolves a users' osu! username from their ID.
@@ -202,28 +311,47 @@ class Module(BaseModule):
         self.log_d(modstring)
         return modstring
 
+    def reload_config(self):
+        BaseModule.reload_config(self)
+
+        # compile message_format once, rather than for every request
+        self.message_template = Template(
+            self.cfg_get("message_format"), MESSAGE_OPTIONS
+        )
+        for key in self.message_template.invalid:
+            self.log_e(f"config error: message_format uses invalid key '{key}'")
+
     def format_message(self, map) -> str:
         """Format map information for `map` using `message_format` from the config.
         :param map: The map object as returned from the osu! API
         :return: The message to send as formatted using `message_format`
         """
-        message = self.cfg_get("message_format")
-
-        for flag, option in MESSAGE_OPT_RE.findall(message):
-            if option not in MESSAGE_OPTIONS:
-                self.log_e(f"config error: message_format uses invalid key '{option}'")
-                continue
+        return self.message_template.render(map)
 
-            message = message.replace(flag, str(MESSAGE_OPTIONS[option](map)))
+    def render_field(self, field: str, message: Message):
+        # fields describe the last request sent; say nothing until there is one
+        if not self.last_map:
+            return NO_MESSAGE_SIGNAL
 
-        return message
+        return MESSAGE_OPTIONS[field](self.last_map)
 
-    def main(self, message: Message):
+    async def main(self, message: Message):
         args = self.get_args(message)
 
-        return self.process_request(message.author, args)
+        if args and args[0].lower() in ["queue", "clear"]:
+            return self.manage_queue(message.author, args[0].lower())
+
+        request = self.process_request(message.author, args, notify=True)
+        if isinstance(request, str):
+            return request
+
+        # the worker tells the requester once the map is looked up
+        if request.ack:
+            return NO_MESSAGE_SIGNAL
 
-    def on_pubmsg(self, message: Message):
+        return self.queued_response(request)
+
+    async def on_pubmsg(self, message: Message):
         if not self.cfg_get("parse_all_messages"):
             return
 
@@ -231,24 +359,104 @@ class Module(BaseModule):
         if message.cmd:
             return
 
-        words = message.text_raw.split(" ")
-        for i, word in enumerate(words):
-            if "osu.ppy.sh/b" not in word:
-                continue
-
-            args = words[i:]
-            response = self.process_request(message.author, args)
-            if (
-                self.cfg_get("respond_all_messages")
-                and NO_MESSAGE_SIGNAL not in response
-            ):
-                # TODO: make this use command response format from a request command?
-                self._bot.send_message(f"@{message.author.name} > {response}")
-
-            # only process first map
+        respond = self.cfg_get("respond_all_messages")
+
+        # only process first map
+        match = OSU_LINK_RE.search(message.text_raw)
+        if not match:
             return
 
-    def process_request(self, author: Author, args):
+        response = self.process_request(
+            message.author,
+            notify=respond,
+            key=beatmap_key(match),
+            mods=match["mods"] or "",
+        )
+        if not isinstance(response, str):
+            if response.ack:
+                return
+
+            response = self.queued_response(response)
+
+        if respond and NO_MESSAGE_SIGNAL not in response:
+            # TODO: make this use command response format from a request command?
+            self._bot.send_message(f"@{message.author.name} > {response}")
+
+    def queued_response(self, request: QueuedRequest) -> str:
+        """Get the response for a request that has just been queued.
+
+        :param request: The queued request.
+        :return: The response to give the requester.
+        """
+        with self._queue_cond:
+            if request not in self.queue:
+                return "Request received!"
+
+            position = self.queue.index(request) + 1
+
+        return f"Request queued! (#{position} in line)"
+
+    def manage_queue(self, author: Author, action: str) -> str:
+        """Show or clear the queue of requests that haven't been sent yet.
+
+        :param author: The user managing the queue. Only moderators and above may clear it.
+        :param action: `queue` to show the queue, or `clear` to clear it.
+        :return: The response to give the user.
+        """
+        with self._queue_cond:
+            if action == "clear":
+                if author.priv < Author.Privilege.MOD:
+                    return "Only moderators may clear the request queue."
+
+                cleared = self.__clear_queue("The request queue was cleared.")
+                return f"Cleared {cleared} queued request(s)."
+
+            pending = list(self.queue)
+
+        if not pending:
+            return "No requests are waiting to be sent."
+
+        shown = ", ".join(
+            f"{r.author.name} ({r.key[0]} {r.key[1]})"
+            for r in pending[:QUEUE_DISPLAY_LIMIT]
+        )
+        if len(pending) > QUEUE_DISPLAY_LIMIT:
+            shown += f", and {len(pending) - QUEUE_DISPLAY_LIMIT} more"
+
+        return f"{len(pending)} request(s) waiting: {shown}"
+
+    def __clear_queue(self, response: str) -> int:
+        """Drop every queued request, answering each with `response`. Must hold `_queue_cond`.
+
+        :return: The amount of requests dropped.
+        """
+        cleared = len(self.queue)
+        while self.queue:
+            request = self.queue.popleft()
+            self.recent.pop(request.key, None)
+            if request.ack:
+                self._bot.send_message(f"@{request.author.name} > {response}")
+
+        return cleared
+
+    def process_request(
+        self,
+        author: Author,
+        args: list = None,
+        notify: bool = False,
+        key: tuple[str, int] = None,
+        mods: str = "",
+    ) -> str | QueuedRequest:
+        """Validate a request and queue it to be looked up and sent to osu!.
+
+        :param author: The user requesting.
+        :param args: The beatmap link, optionally followed by mods. Not needed if `key` is given.
+        :param notify: Whether to tell the requester in chat if the request fails after being queued.
+            With `ack_after_lookup` set, they are told once it is sent, too.
+        :param key: The map, if already parsed. See `beatmap_key`.
+        :param mods: The mods, if already parsed, as typed by the requester.
+        :return: The `QueuedRequest`, or the response to give the requester if it was refused.
+        """
         # do not continue if either username or target failed to resolve
         if not self.username:
             return (
@@ -269,71 +477,124 @@ class Module(BaseModule):
             if author.priv < command.privilege:
                 return NO_MESSAGE_SIGNAL
 
-        # do not continue if no args are provided
-        if not args:
-            return "Provide a map to request."
-
-        # use first arg as request (or submode toggle)
-        req = args[0].lower()
-
-        # use second arg as mods
-        mods = ""
-        if len(args) > 1:
-            mods = self.generate_mods_string(args[1].upper())
-
-        # get map info; use full re first as it's more common
-        if self.beatmap_re.match(req):
-            # returns [()]? oh well, grab [0] so we have ()
-            ids = self.beatmap_re.findall(req)[0]
-
-            # if mapid isn't empty use it
-            if ids[1]:
-                # beatmap
-                id = ids[1]
-                self.log_d(f"retrieving osu map info for beatmap id {id}")
-                map = self.api_helper.get_beatmap(id)
-
-            # if mapid is empty use mapsetid
-            else:
-                # beatmapset
-                id = ids[0]
-                self.log_d(f"retrieving top diff info for beatmapset id {id}")
-                mapset = self.api_helper.get_beatmapset(id)
-                maps = mapset["beatmaps"]
-                # sort mapset descending by difficulty so req[0] gives top diff
-                maps.sort(key=lambda m: m["difficulty_rating"], reverse=True)
-                map = maps[0]
-                # set map mapset to mapset for use within formatting
-                map["beatmapset"] = mapset
-
-        # use short re? (osu.ppy.sh/b/id)
-        elif self.b_re.match(req):
-            id = self.b_re.findall(req)[0]
+        if not key:
+            # do not continue if no args are provided
+            if not args:
+                return "Provide a map to request."
+
+            # use first arg as request, second as mods
+            match = OSU_LINK_RE.fullmatch(args[0])
+            if not match:
+                return "Could not resolve beatmap link format."
+
+            key = beatmap_key(match)
+            if len(args) > 1:
+                mods = args[1]
+
+        mods = self.generate_mods_string(mods.upper()) if mods else ""
+
+        request = QueuedRequest(
+            author, key, mods, notify, ack=notify and self.cfg_get("ack_after_lookup")
+        )
+
+        with self._queue_cond:
+            if self._closed:
+                return "Requests are closed."
+
+            # ignore the same map being requested over and over
+            now = time.time()
+            window = self.cfg_get("dedupe_window")
+            self.recent = {k: t for k, t in self.recent.items() if now - t < window}
+            if key in self.recent:
+                self.log_d(f"{key[0]} {key[1]} was requested recently; ignoring")
+                return "That map was already requested recently."
+
+            self.recent[key] = now
+            self.queue.append(request)
+            self._queue_cond.notify()
+
+        # set cooldown
+        self.author_cds[author.uid] = time.time()
+
+        return request
+
+    def work(self):
+        """Look up and send queued requests until this module is unimported. Runs on a worker thread."""
+        while True:
+            with self._queue_cond:
+                while not self.queue and not self._closed:
+                    self._queue_cond.wait()
+
+                if self._closed:
+                    return
+
+                request = self.queue.popleft()
+
+            try:
+                sent, response = self.send_request(request)
+            except Exception:
+                self.log_e(traceback.format_exc())
+                sent, response = False, "Your request could not be sent."
+
+            if not sent:
+                # let the map be requested again
+                with self._queue_cond:
+                    self.recent.pop(request.key, None)
+
+            if request.ack or (request.notify and not sent):
+                self._bot.send_message(f"@{request.author.name} > {response}")
+
+    def send_request(self, request: QueuedRequest) -> tuple[bool, str]:
+        """Look up the map for `request` and send it to osu!.
+
+        :param request: The request to send.
+        :return: Whether the request was sent, and the response to give the requester.
+        """
+        kind, id = request.key
+        if kind == "beatmap":
             self.log_d(f"retrieving osu map info for beatmap id {id}")
-            map = self.api_helper.get_beatmap(id)
+            map = self.beatmaps.get_beatmap(id)
 
-        # give up
         else:
-            return "Could not resolve beatmap link format."
+            self.log_d(f"retrieving top diff info for beatmapset id {id}")
+            mapset = self.beatmaps.get_beatmapset(id)
+            if not mapset:
+                return False, "Could not retrieve beatmap information."
+
+            maps = mapset["beatmaps"]
+            # sort mapset descending by difficulty so req[0] gives top diff
+            maps.sort(key=lambda m: m["difficulty_rating"], reverse=True)
+            map = maps[0]
+            # set map mapset to mapset for use within formatting
+            map["beatmapset"] = mapset
 
         if not map:
-            return "Could not retrieve beatmap information."
+            return False, "Could not retrieve beatmap information."
 
         # add request mods to map dict and format the message
-        map["mods"] = mods
-        map["sender"] = author
+        map["mods"] = request.mods
+        map["sender"] = request.author
         message = self.format_message(map)
 
-        # send message, set cooldown and inform requester
         self.send_osu_message(message)
-        self.author_cds[author.uid] = time.time()
+        self.last_map = map
 
-        return f"{map['beatmapset']['artist']} - {map['beatmapset']['title']} | Request sent!"
+        return (
+            True,
+            f"{map['beatmapset']['artist']} - {map['beatmapset']['title']} | Request sent!",
+        )
 
     def send_osu_message(self, msg: str):
-        """Send `msg` as an osu! message to `target` as `username`
+        """Send `msg` as an osu! message to `target` as `username`, waiting if sending too quickly.
         :param msg: The message to send
         """
+        with self._osu_lock:
+            wait = self._osu_bucket.wait_time()
+            while wait:
+                time.sleep(wait)
+                wait = self._osu_bucket.wait_time()
+            self._osu_bucket.take()
+
         self.log_d(f"sending osu! message to {self.username}: '{msg}'")
 
         self.osu_irc_bot.send_message(msg)
@@ -4,11 +4,22 @@
 
 from src.plugins import BaseModule
 from src.config import BASE_CONFIG_PATH
-from src.definitions import Author, Message, RepeatTimer
+from src.definitions import Author, Message
 
+from bisect import bisect_left
 import os
 import random
 import sqlite3
+import threading
+
+SQLITE_MAX_PARAMS = 900
+"""Maximum amount of parameters to bind to one query; SQLite may be built with a limit as low as 999."""
+
+GRANT_XP_SQL = """
+INSERT INTO xp VALUES(?,?)
+ON CONFLICT(user) DO UPDATE SET amt = amt + excluded.amt
+"""
+"""Add XP to a user, creating them if they don't exist."""
 
 
 class Module(BaseModule):
@@ -21,6 +32,9 @@ class Module(BaseModule):
         "xp_inactive_range": [1, 1],
         # Amount (min, max) to grant to active users. Default is (2, 3).
         "xp_active_range": [2, 3],
+        # Optional tiers of [messages, [min, max]]: users who sent at least `messages` since the last grant
+        # get (min, max) instead of xp_active_range. The highest tier reached applies, e.g. [[1, [2, 3]], [10, [4, 5]]]
+        "xp_active_tiers": [],
         # Amount of XP required for level 2.
         "level_requirement": 30,
         # Additional amount of XP (multiplicative) required for each new level.
@@ -36,17 +50,21 @@ class Module(BaseModule):
         # resolve path
         self.db_path = f"{BASE_CONFIG_PATH}/{self._bot.channel_id}/modules/xp.db"
 
+        # sqlite3 connections can only be used on the thread that made them,
+        # and module code runs on several, so each thread gets its' own
+        self._local = threading.local()
+
         # init the sqlite3 connection
         try:
-            self.db = sqlite3.connect(self.db_path)
+            db = self.get_db()
 
         except sqlite3.OperationalError:
             # Make folder and reattempt init
             os.mkdir("modules/xp_store")
-            self.db = sqlite3.connect(self.db_path)
+            db = self.get_db()
 
         # Create the table if it doesn't exist
-        self.db.execute(
+        db.execute(
             """
         CREATE TABLE IF NOT EXISTS xp (
             user,
@@ -56,50 +74,92 @@ class Module(BaseModule):
         """
         )
 
-        # Create active users array for activity bonus
-        self.active_users = []
+        # Index XP amounts so ranks and leaderboards don't scan the whole table
+        db.execute("CREATE INDEX IF NOT EXISTS xp_amt ON xp(amt)")
+
+        # Level thresholds, built by get_level() for the current level config
+        self._level_config = None
+        self._level_thresholds = []
+
+        # Messages sent per user since the last grant, for activity bonus.
+        # Swapped out for a fresh dict on each tick, so chat never waits on a grant.
+        self.activity = {}
+        self._activity_lock = threading.Lock()
 
         # Tick XP every XP_GRANT_FREQUENCY seconds
-        self.timer = RepeatTimer(self.cfg_get("xp_grant_frequency"), self.tick)
-        self.timer.start()
+        self.schedule_every(self.cfg_get("xp_grant_frequency"), self.tick)
 
-    def __del__(self):
-        self.timer.cancel()
+    def get_db(self) -> sqlite3.Connection:
+        """Get the XP database connection for the current thread, opening it if needed.
+
+        :return: The `sqlite3.Connection` for this thread.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+
+        return db
 
     # Get viewerlist and do XP gain logic
     def tick(self):
         self.log_d(f"running XP grant logic")
-        # Create a new connection for this thread
-        thread_db = sqlite3.connect(self.db_path)
+        # Shared with other modules, and only fetched in full every so often,
+        # unless Twitch isn't sending joins and parts to keep it up to date
+        users = self._bot.presence.chatters(
+            max_age_without_events=self.cfg_get("xp_grant_frequency")
+        )
+
+        # Take this window's activity and start the next one
+        with self._activity_lock:
+            activity, self.activity = self.activity, {}
 
-        users = self._bot.auth.get_all_chatters(self._bot.channel_id, self._bot.user_id)
+        if not users and not activity:
+            return
 
-        # Give XP to each user
+        omit_users = set(self.cfg_get("omit_users"))
+        inactive_range = self.cfg_get("xp_inactive_range")
+        tiers = self.get_active_tiers()
+
+        # Chatter lists lag behind; anyone who spoke is clearly here
+        users = set(users)
+        users.update(activity)
+
+        # Resolve how much XP to grant to each user
+        grants = []
         for user in users:
-            user = user.lower()
-            if user in self.cfg_get("omit_users"):
+            if user in omit_users:
                 continue
 
-            # Resolve how much XP to grant to this user
-            active_range = self.cfg_get("xp_active_range")
-            inactive_range = self.cfg_get("xp_inactive_range")
-            if user in self.active_users:
-                amt = random.randint(active_range[0], active_range[1])
-            else:
-                amt = random.randint(inactive_range[0], inactive_range[1])
+            amt_range = inactive_range
+            messages = activity.get(user, 0)
+            if messages:
+                for min_messages, tier_range in tiers:
+                    if messages >= min_messages:
+                        amt_range = tier_range
+                        break
+
+            grants.append((user, random.randint(amt_range[0], amt_range[1])))
+
+        # Grant it all in one transaction
+        with self.get_db() as db:
+            db.executemany(GRANT_XP_SQL, grants)
 
-            # Grant it to the user
-            thread_db.execute("INSERT OR IGNORE INTO xp VALUES(?,?)", (user, 0))
-            thread_db.execute(f'UPDATE xp SET amt = amt + {amt} WHERE user = "{user}"')
+    def get_active_tiers(self) -> list:
+        """Return the activity tiers from the config, highest first.
 
-        # Commit XP modifications and clear active users for the next window.
-        thread_db.commit()
+        :return: A list of [`messages`, [`min`, `max`]]. Falls back to one tier of `xp_active_range` for any activity.
+        """
+        tiers = self.cfg_get("xp_active_tiers")
+        if not tiers:
+            return [[1, self.cfg_get("xp_active_range")]]
 
-        self.active_users.clear()
+        return sorted(tiers, key=lambda tier: tier[0], reverse=True)
 
     def get_top(self, rank: int):
         """Return the top 3 XP holders."""
-        with self.db as db:
+        with self.get_db() as db:
             if rank:
                 user = self.get_user(rank=rank)
                 if user:
@@ -111,8 +171,8 @@ class Module(BaseModule):
 
             self.log_d(f"Retrieving top 3 XP holders")
             cs = db.cursor()
-            cs.execute(f"SELECT user,amt FROM xp ORDER BY amt DESC")
-            res = cs.fetchmany(3)
+            cs.execute("SELECT user, amt FROM xp ORDER BY amt DESC LIMIT 3")
+            res = cs.fetchall()
 
             return " | ".join([f"{r[0]}: {r[1]}" for r in res])
 
@@ -120,52 +180,116 @@ class Module(BaseModule):
         """Return the user, position, XP, and level.
 
         :param user: The name of the user
-        :param rank: The rank of the user
-        :return: A list containing [`name`, `rank`, `level`, `xp`]
+        :param rank: The rank of the user. Negative ranks count up from last place.
+        :return: A list containing [`name`, `rank`, `level`, `xp`], or `False` if there is no such user.
         """
         self.log_d(f"retrieving user:{user} or rank:{rank}")
 
-        with self.db as db:
-            cs = db.cursor()
-
-            # Getting their position
-            all = tuple(
-                map(
-                    lambda x: x,
-                    cs.execute("SELECT user, amt FROM xp ORDER BY amt DESC").fetchall(),
-                )
-            )
+        with self.get_db() as db:
             if user:
                 if user.startswith("@"):
                     user = user[1:]
 
-                all_names = [i[0] for i in all]
+                row = db.execute("SELECT user, amt FROM xp WHERE user = ?", (user,))
+                row = row.fetchone()
 
                 # Return false if they don't exist.
-                if user not in all_names:
+                if not row:
                     return False
 
-                rank = all_names.index(user)
+                # Getting their position
+                rank = db.execute(
+                    "SELECT COUNT(*) FROM xp WHERE amt > ?", (row[1],)
+                ).fetchone()[0]
 
             else:
-                if rank > len(all):
-                    raise ValueError
-
                 # to allow negative indices, show last place, etc.
-                if rank > 0:
-                    rank -= 1
+                if rank < 0:
+                    row = db.execute(
+                        "SELECT user, amt FROM xp ORDER BY amt ASC LIMIT 1 OFFSET ?",
+                        (-rank - 1,),
+                    ).fetchone()
+                    if row:
+                        rank += db.execute("SELECT COUNT(*) FROM xp").fetchone()[0]
 
-            user = all[rank]
-            username = user[0]
-            xp = user[1]
+                else:
+                    if rank > 0:
+                        rank -= 1
 
-        next_lv_req = self.cfg_get("level_requirement")
-        level = 1
-        while xp > next_lv_req:
-            level += 1
-            next_lv_req = next_lv_req * self.cfg_get("level_increment")
+                    row = db.execute(
+                        "SELECT user, amt FROM xp ORDER BY amt DESC LIMIT 1 OFFSET ?",
+                        (rank,),
+                    ).fetchone()
 
-        return (username, rank + 1, level, xp)
+                if not row:
+                    return False
+
+            username, xp = row
+
+        return (username, rank + 1, self.get_level(xp), xp)
+
+    def get_level(self, xp: int) -> int:
+        """Return the level for `xp` XP.
+
+        :param xp: The amount of XP.
+        :return: The level.
+        """
+        config = (self.cfg_get("level_requirement"), self.cfg_get("level_increment"))
+        requirement, increment = config
+
+        # Thresholds only ever grow; anything below the first is level 1
+        if increment <= 1:
+            self.log_e("config error: level_increment must be greater than 1")
+            return 1
+
+        thresholds = self._level_thresholds
+        if config != self._level_config:
+            thresholds = [requirement]
+
+        # Extend the table as far as this amount of XP needs
+        if thresholds[-1] < xp:
+            thresholds = list(thresholds)
+            while thresholds[-1] < xp:
+                thresholds.append(thresholds[-1] * increment)
+
+        if thresholds is not self._level_thresholds:
+            self._level_thresholds = thresholds
+            self._level_config = config
+
+        return bisect_left(thresholds, xp) + 1
+
+    def get_levels(self, amounts: list) -> list:
+        """Return the level for every amount of XP in `amounts`.
+
+        :param amounts: The amounts of XP.
+        :return: The levels, in the same order as `amounts`.
+        """
+        if not amounts:
+            return []
+
+        # Build the table once for the largest amount
+        self.get_level(max(amounts))
+        thresholds = self._level_thresholds
+
+        return [bisect_left(thresholds, xp) + 1 for xp in amounts]
+
+    def get_user_levels(self, users: list) -> dict:
+        """Return the level and XP of every user in `users` that has tracked XP.
+
+        :param users: The names of the users.
+        :return: A dict of `name` to (`level`, `xp`).
+        """
+        rows = []
+        with self.get_db() as db:
+            for i in range(0, len(users), SQLITE_MAX_PARAMS):
+                chunk = users[i : i + SQLITE_MAX_PARAMS]
+                rows += db.execute(
+                    f"SELECT user, amt FROM xp WHERE user IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+
+        levels = self.get_levels([amt for _, amt in rows])
+        return {user: (level, amt) for (user, amt), level in zip(rows, levels)}
 
     def mod_user(self, args):
         """Perform an action on a user."""
@@ -187,7 +311,7 @@ class Module(BaseModule):
             user = user[1:]
 
         self.log_d(f"running XPMod action {action} {args} on {user}")
-        with self.db as db:
+        with self.get_db() as db:
             if action == "set":
                 # verify needed args exist
                 try:
@@ -196,7 +320,7 @@ class Module(BaseModule):
                     return "Please provide a number to set the user's XP to."
 
                 # perform update
-                db.execute(f'UPDATE xp SET amt = {amt} WHERE user = "{user}"')
+                db.execute("UPDATE xp SET amt = ? WHERE user = ?", (amt, user))
                 msg = f"Set {user}'s XP to {amt}."
 
             elif action == "transfer":
@@ -231,8 +355,8 @@ class Module(BaseModule):
                     t_amt = tar[2] + amount
 
                 # perform updates
-                db.execute(f'UPDATE xp SET amt = {s_amt} WHERE user = "{src[0]}"')
-                db.execute(f'UPDATE xp SET amt = {t_amt} WHERE user = "{tar[0]}"')
+                db.execute("UPDATE xp SET amt = ? WHERE user = ?", (s_amt, src[0]))
+                db.execute("UPDATE xp SET amt = ? WHERE user = ?", (t_amt, tar[0]))
                 msg = f"Transferred {amount} points from {user} to {tar[0]}."
 
             elif action == "ban":
@@ -242,7 +366,7 @@ class Module(BaseModule):
 
                 # create the user if they don't already exist
                 db.execute("INSERT OR IGNORE INTO xp VALUES(?,?)", (user, 0))
-                db.execute(f'UPDATE xp SET amt = 0 WHERE user = "{user}"')
+                db.execute("UPDATE xp SET amt = 0 WHERE user = ?", (user,))
 
                 omit_users.append(user)
                 self.cfg_set("omit_users", omit_users)
@@ -294,8 +418,8 @@ class Module(BaseModule):
         else:
             return f"{arg} has no tracked XP."
 
-    def on_pubmsg(self, message: Message):
-        return
-        # Add this user to the active users list.
-        if not message.author.name in self.active_users:
-            self.active_users.append(message.author.name.lower())
+    async def on_pubmsg(self, message: Message):
+        # Count this message towards the user's activity; runs for every message, so keep it cheap
+        name = message.author.name
+        with self._activity_lock:
+            self.activity[name] = self.activity.get(name, 0) + 1
@@ -1,11 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from requests import get, post
+import re
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
 import socket
+import threading
 import time
 import webbrowser
 
+from src.cache import TTLCache
 from src.config import ConfigHandler, BASE_CONFIG_PATH
 from src.definitions import Singleton
+from src.scheduler import scheduler
+from src.stats import stats
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+"""HTTP methods that are safe to send again if the server may have already handled them."""
 
 
 class OAuth2Handler(Singleton):
@@ -26,6 +36,31 @@ class OAuth2Handler(Singleton):
     """API endpoint to get/refresh the OAuth token at."""
     api = ""
     """Base URL of the API."""
+    pool_size = 10
+    """Maximum amount of kept-alive connections to keep open per host."""
+    timeout = 10
+    """Default time to wait for a response, in seconds."""
+    max_retries = 3
+    """Maximum amount of times to retry a request that was rate limited (429), failed server-side (5xx), or could not connect.
+
+    Only rate limited requests are retried for methods not in `IDEMPOTENT_METHODS` (e.g. POST),
+    as the server may have handled them already.
+    """
+    retry_backoff = 0.5
+    """Base delay between retries, in seconds. Doubles every attempt, unless the server says how long to wait."""
+    retry_backoff_max = 30
+    """Maximum delay between retries, in seconds."""
+    cache_ttls = {}
+    """Map of endpoint path prefixes to how long to cache GET responses from them, in seconds.
+
+    The longest matching prefix is used. Endpoints not matching any prefix are not cached.
+    """
+    cache_size = 256
+    """Maximum amount of GET responses to cache."""
+    refresh_margin = 5 * 60
+    """How long before the token expires to refresh it in the background, in seconds."""
+    refresh_retry = 60
+    """Time to wait before trying again if a background refresh fails, in seconds."""
 
     def __init__(self, cfgpath: int):
         """Create a new `OAuthV2Handler`.
@@ -37,14 +72,39 @@ class OAuth2Handler(Singleton):
         )
         self.cfg = self.cfg_handler.read()
 
+        # Keep connections alive between calls rather than handshaking every request
+        self.session = Session()
+        adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache = TTLCache(self.cache_size)
+
+        # Only one refresh at a time; see __refresh_token()
+        self._token_lock = threading.Lock()
+        self._refresh_job = None
+        self._refresh_failed = 0
+        self._closed = False
+
         self.set_fields()
 
         if "token" not in self.cfg:
             self.__get_auth()
         else:
             # refresh token automatically if expired
+            # this is the only time we can ask the user to log in again
             if self.token["expiry"] < time.time():
-                self.__refresh_token()
+                self.__refresh_token(interactive=True)
+
+        self.__schedule_refresh()
+
+    def close(self):
+        """Stop refreshing the token in the background. Call once this `OAuth2Handler` is no longer used,
+        so it doesn't keep refreshing with a refresh token another handler has since replaced.
+        """
+        self._closed = True
+        if self._refresh_job:
+            self._refresh_job.cancel()
 
     def set_fields(self):
         """Set the fields obtained from reading `self.cfgpath` to fields of this `OAuth2Handler`."""
@@ -132,22 +192,66 @@ class OAuth2Handler(Singleton):
         }
         self.__get_token(data)
 
-    def __refresh_token(self):
-        """Refresh `self.token` using its' refresh code."""
-        if not self.token:
+    def __schedule_refresh(self, delay: float = None):
+        """Refresh the token in the background, `refresh_margin` seconds before it expires.
+
+        :param delay: Time to wait before refreshing instead, in seconds.
+        """
+        if self._refresh_job:
+            self._refresh_job.cancel()
+
+        if self._closed or not self.token:
             return
 
-        logging.debug(f"refreshing '{self.name}' OAuth token")
+        if delay is None:
+            delay = self.token.get("expiry", 0) - self.refresh_margin - time.time()
 
-        data = {
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-            "grant_type": "refresh_token",
-            "refresh_token": self.token["refresh_token"],
-        }
-        if not self.__get_token(data):
+        self._refresh_job = scheduler.after(max(delay, 0), self.__refresh_token)
+
+    def __refresh_token(self, interactive: bool = False) -> bool:
+        """Refresh `self.token` using its' refresh code.
+
+        Only one refresh runs at a time; anyone calling during one waits for it rather than refreshing again.
+
+        :param interactive: Whether to fall back to authorizing in the browser if the refresh fails.
+        Only ever do this on startup, as it blocks until the user finishes.
+
+        :return: Whether the token was refreshed.
+        """
+        if self._closed or not self.token:
+            return False
+
+        token = self.token
+        with self._token_lock:
+            # someone else refreshed it while we waited
+            if self.token is not token:
+                return True
+
+            logging.debug(f"refreshing '{self.name}' OAuth token")
+
+            data = {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "grant_type": "refresh_token",
+                "refresh_token": self.token["refresh_token"],
+            }
+            refreshed = self.__get_token(data)
+
+        if refreshed:
+            self.__schedule_refresh()
+
+        elif interactive:
             self.__get_auth()
 
+        else:
+            logging.error(
+                f"'{self.name}' OAuth token refresh failed; trying again in {self.refresh_retry}s"
+            )
+            self._refresh_failed = time.time()
+            self.__schedule_refresh(self.refresh_retry)
+
+        return refreshed
+
     def __get_token(self, data):
         """Get a new token or refresh an existing one using `data`.
 
@@ -157,7 +261,13 @@ class OAuth2Handler(Singleton):
             "Accept": "application/json",
             "Content-Type": "application/json",
         }
-        token = post(self.oauth_token_uri, headers=headers, json=data)
+        try:
+            token = self.session.post(
+                self.oauth_token_uri, headers=headers, json=data, timeout=self.timeout
+            )
+        except RequestException as err:
+            logging.error(f"'{self.name}' OAuth token grab failed! ({err})")
+            return False
 
         if not token.status_code == 200:
             logging.error(f"'{self.name}' OAuth token grab failed! ({token.json()})")
@@ -168,21 +278,58 @@ class OAuth2Handler(Singleton):
         self.__save()
         return True
 
-    def __request(self, method, endpoint: str, data: dict = None):
+    def __retry_delay(self, attempt: int, response=None) -> float:
+        """Get how long to wait before retrying a request.
+
+        Honours `Ratelimit-Reset` (Twitch) when rate limited, and `Retry-After` if the response has them.
+
+        :param attempt: The amount of attempts made so far, starting at 0.
+        :param response: The response of the failed attempt, if there was one.
+
+        :return: The delay in seconds.
+        """
+        delay = self.retry_backoff * (2**attempt)
+
+        if response is not None:
+            try:
+                if (
+                    response.status_code == 429
+                    and "Ratelimit-Reset" in response.headers
+                ):
+                    delay = float(response.headers["Ratelimit-Reset"]) - time.time()
+                elif "Retry-After" in response.headers:
+                    delay = float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+
+        return min(max(delay, 0), self.retry_backoff_max)
+
+    def __request(
+        self, method: str, endpoint: str, data: dict = None, timeout: float = None
+    ):
         """Send a request to an endpoint of `self.api`.
 
+        Retries up to `self.max_retries` times if rate limited, on server errors, or if the connection failed.
+        Requests that aren't idempotent (e.g. POST) are only retried if rate limited, so they are never sent twice.
         Returns `False` if the request was unsuccessful (e.g. 401, 404).
 
-        :param method: `requests` method to use.
+        :param method: HTTP method to use.
         :param endpoint: Endpoint relative to `self.api` to call.
         :param data: The json data to send in the request, frequently used in POST requests.
+        :param timeout: Time to wait for a response, in seconds. Uses `self.timeout` if `None`.
 
         :return: The json data of the response, or `False` if unsuccessful.
         """
         if not self.token:
             return False
 
-        if time.time() >= self.token.get("expiry", 0):
+        # normally refreshed in the background well before this;
+        # if not (e.g. the machine was asleep), wait for a refresh, but never ask the user to log in here
+        now = time.time()
+        if (
+            now >= self.token.get("expiry", 0)
+            and now - self._refresh_failed >= self.refresh_retry
+        ):
             self.__refresh_token()
 
         url = self.api + endpoint
@@ -194,43 +341,115 @@ class OAuth2Handler(Singleton):
             "Accept": "application/json",
         }
 
-        if data:
-            response = method(url, headers=headers, json=data)
-        else:
-            response = method(url, headers=headers)
+        if timeout is None:
+            timeout = self.timeout
+
+        # ids are replaced so every beatmap/user doesn't get its' own metric
+        metric = re.sub(r"\d+", ":id", endpoint.split("?", 1)[0])
+        metric = f"{self.name} {method} {metric}"
+
+        idempotent = method in IDEMPOTENT_METHODS
+
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, headers=headers, json=data, timeout=timeout
+                )
 
-        logging.debug(response.status_code)
-        logging.debug(response.json())
+            except RequestException as err:
+                stats.observe("http", metric, time.perf_counter() - start, True)
+
+                if not idempotent or attempt == self.max_retries:
+                    logging.error(f"'{self.name}' {method} {endpoint} failed: {err}")
+                    return False
+
+                logging.debug(
+                    f"'{self.name}' {method} {endpoint} failed ({err}), retrying"
+                )
+                time.sleep(self.__retry_delay(attempt))
+                continue
+
+            stats.observe(
+                "http",
+                metric,
+                time.perf_counter() - start,
+                not 200 <= response.status_code < 300,
+            )
+            logging.debug(response.status_code)
 
-        if response.status_code >= 200 or response.status_code < 300:
+            # a 429 was never handled, so anything can be sent again
+            if response.status_code == 429 or (
+                idempotent and response.status_code >= 500
+            ):
+                if attempt < self.max_retries:
+                    delay = self.__retry_delay(attempt, response)
+                    logging.debug(
+                        f"'{self.name}' {method} {endpoint} returned {response.status_code}, retrying in {delay:.1f}s"
+                    )
+                    time.sleep(delay)
+                    continue
+
+            break
+
+        logging.debug(response.text)
+
+        if 200 <= response.status_code < 300:
             return response.json()
 
-        logging.debug(response.json())
         return False
 
-    def _get(self, endpoint: str = None, data: dict = None) -> bool | dict:
+    def _get(
+        self, endpoint: str = None, data: dict = None, timeout: float = None
+    ) -> bool | dict:
         """Send a GET request to `endpoint` of `self.api`.
 
         :param endpoint: Endpoint relative to `self.api` to call.
         :param data: The json data to send in the GET.
+        :param timeout: Time to wait for a response, in seconds. Uses `self.timeout` if `None`.
 
         :return: The json data of the response, or `False` if unsuccessful.
         """
-        if data:
-            return self.__request(get, endpoint, data)
-        return self.__request(get, endpoint)
+        ttl = self.get_cache_ttl(endpoint)
+        if not ttl or data:
+            return self.__request("GET", endpoint, data, timeout)
+
+        return self.cache.get_or_load(
+            endpoint, lambda: self.__request("GET", endpoint, None, timeout), ttl
+        )
+
+    def get_cache_ttl(self, endpoint: str) -> float | None:
+        """Get how long GET responses from `endpoint` are cached for.
+
+        :param endpoint: Endpoint relative to `self.api`, including any query string.
+
+        :return: The time-to-live in seconds, or `None` if `endpoint` is not cached.
+        """
+        path = endpoint.split("?", 1)[0]
+
+        ttl = None
+        longest = -1
+        for prefix, prefix_ttl in self.cache_ttls.items():
+            if path.startswith(prefix) and len(prefix) > longest:
+                ttl = prefix_ttl
+                longest = len(prefix)
+
+        return ttl
 
-    def _post(self, endpoint: str = None, data: dict = None) -> bool | dict:
+    def _post(
+        self, endpoint: str = None, data: dict = None, timeout: float = None
+    ) -> bool | dict:
         """Send a POST request to `endpoint` of `self.api`.
 
         Returns `False` if unsuccessful.
 
         :param endpoint: Endpoint relative to `self.api` to call.
         :param data: The json data to send in the POST.
+        :param timeout: Time to wait for a response, in seconds. Uses `self.timeout` if `None`.
 
         :return: The json data of the response, or `False` if unsuccessful.
         """
-        return self.__request(post, endpoint, data)
+        return self.__request("POST", endpoint, data, timeout)
 
 
 class TwitchOAuth2Helper(OAuth2Handler):
@@ -246,6 +465,16 @@ class TwitchOAuth2Helper(OAuth2Handler):
     oauth_grant_uri = "https://id.twitch.tv/oauth2/authorize"
     oauth_token_uri = "https://id.twitch.tv/oauth2/token"
     api = "https://api.twitch.tv/helix"
+    cache_ttls = {
+        # stream status
+        "/streams": 30,
+        # login -> id mappings
+        "/users": 6 * 60 * 60,
+    }
+    CHATTERS_PAGE_SIZE = 1000
+    """Most chatters Twitch returns per page."""
+    STREAMS_BATCH_SIZE = 100
+    """Most `user_id` Twitch accepts per `/streams` request."""
 
     def set_fields(self):
         super().set_fields()
@@ -313,7 +542,7 @@ class TwitchOAuth2Helper(OAuth2Handler):
         if user_id:
             query = self._get(f"/streams?user_id={user_id}")
 
-            if len(query["data"]) == 0:
+            if not query or len(query["data"]) == 0:
                 return False
 
             return query["data"][0]
@@ -321,7 +550,7 @@ class TwitchOAuth2Helper(OAuth2Handler):
         if user_login:
             query = self._get(f"/streams?user_login={user_login}")
 
-            if len(query["data"]) == 0:
+            if not query or len(query["data"]) == 0:
                 return False
 
             return query["data"][0]
@@ -337,7 +566,7 @@ class TwitchOAuth2Helper(OAuth2Handler):
         """
         query = self._get(f"/users?login={user_login}")
 
-        if len(query["data"]) == 0:
+        if not query or len(query["data"]) == 0:
             return False
 
         return int(query["data"][0]["id"])
@@ -345,56 +574,70 @@ class TwitchOAuth2Helper(OAuth2Handler):
     def get_all_chatters(self, channel_id: int, user_id: int) -> bool | list:
         """Return a list of `user_login` for all users in the current channel.
 
-        Automatically paginates and returns all users.
+        Automatically paginates and returns all users. See `iter_chatters` to process them page by page instead.
 
         :param channel_id: The channel ID to get chatters for.
         :param user_id: The User ID of the current OAuth2 session user.
 
         :return: A `list` of all `user_login` connected to the chat for `channel_id`.
+        :raises ConnectionError: If any page could not be fetched.
         """
-        results = []
-        query = self._get(
-            f"/chat/chatters?broadcaster_id={channel_id}&moderator_id={user_id}&first=1000"
-        )
+        return list(self.iter_chatters(channel_id, user_id))
 
-        # nothing there. return empty list here to prevent errors
-        if len(query["data"]) == 0:
-            return results
+    def iter_chatters(self, channel_id: int, user_id: int):
+        """Yield the `user_login` of every user in the current channel, fetching each page only as it is needed.
 
-        results += [user["user_login"] for user in query["data"]]
+        :param channel_id: The channel ID to get chatters for.
+        :param user_id: The User ID of the current OAuth2 session user.
+
+        :return: A generator of `user_login` connected to the chat for `channel_id`.
+        :raises ConnectionError: If a page could not be fetched, as the users yielded so far are incomplete.
+        """
+        endpoint = f"/chat/chatters?broadcaster_id={channel_id}&moderator_id={user_id}&first={self.CHATTERS_PAGE_SIZE}"
+        query = self._get(endpoint)
 
         # paginate, if applicable
-        # query["pagination"] should be empty (== False) if no more than 1000
-        while query["pagination"]:
-            query = self._get(
-                f"/chat/chatters?broadcaster_id={channel_id}&moderator_id={user_id}&first=1000&after={query['pagination']['cursor']}"
-            )
-            results += [user["user_login"] for user in query["data"]]
+        # query["pagination"] should be empty (== False) if no more than one page
+        while True:
+            if not query:
+                raise ConnectionError(f"could not get chatters for {channel_id}")
+
+            for user in query["data"]:
+                yield user["user_login"]
 
-        return results
+            if not query["pagination"]:
+                break
+
+            query = self._get(f"{endpoint}&after={query['pagination']['cursor']}")
 
     def get_live_streams(self, channels: list) -> list:
         """Return a list of live streams from a list of `user_id`.
 
-        Automatically paginates and returns all live streams in `channels`.
+        Looks up `STREAMS_BATCH_SIZE` channels per request, with the requests made concurrently.
 
         :param channels: The list of `user_id` to get live channels for.
 
         :return: A `list` of all `[user_id, user_login]` in `channels` currently live on Twitch.
         """
-        # TODO: support more than 100 streams, but really, that should never happen for a single installation?
-        # in meantime cull to 100
-        channels = channels[:100]
-
-        results = []
-        query = self._get(
-            f"/streams?{'&'.join([f'user_id={id}' for id in channels])}&type=live&first=100"
-        )
-
-        # nothing there. return empty list here to prevent errors
-        if len(query["data"]) == 0:
-            return results
-
-        results += [[user["user_id"], user["user_login"]] for user in query["data"]]
+        batches = [
+            channels[i : i + self.STREAMS_BATCH_SIZE]
+            for i in range(0, len(channels), self.STREAMS_BATCH_SIZE)
+        ]
+        if not batches:
+            return []
+
+        with ThreadPoolExecutor(min(len(batches), self.pool_size)) as pool:
+            queries = pool.map(
+                lambda batch: self._get(
+                    f"/streams?{'&'.join([f'user_id={id}' for id in batch])}&type=live&first={self.STREAMS_BATCH_SIZE}"
+                ),
+                batches,
+            )
 
-        return results
+            # a failed batch just means no streams from it; same as before
+            return [
+                [user["user_id"], user["user_login"]]
+                for query in queries
+                if query
+                for user in query["data"]
+            ]
@@ -5,60 +5,54 @@ import traceback
 
 from src.commands import CommandsHandler
 from src.plugins import ModulesHandler
-from src.config import ConfigHandler, DEFAULT_CHANNEL
+from src.config import ConfigHandler, DEFAULT_CHANNEL, write_behind
 from src.authentication import TwitchOAuth2Helper
 from src.definitions import Author, Message, status_from_user_privilege
+from src.pipeline import MessagePipeline
+from src.presence import ChatterPresence
+from src.ratelimit import SendQueue
+from src.stream import StreamState
+
+
+class TwitchIRC(irc.bot.SingleServerIRCBot):
+    """A connection to Twitch chat, shared by the `TwitchBot` of every channel it joins."""
 
-class TwitchBot(irc.bot.SingleServerIRCBot):
     auth: TwitchOAuth2Helper
-    channel_id: int
-    channel_name: str
-    channel: str
-    commands_handler: CommandsHandler
-    modules_handler: ModulesHandler
-    cfgpath: str
-    """Path to the currently used channel config file."""
-    prefix: str
-    always_import_list: list
-    """List of modules to always import, regardless of whether they're used in commands."""
+    bots: dict
+    """Map of `#channel` to the `TwitchBot` for that channel."""
+    pipeline: MessagePipeline
+    send_queue: SendQueue
+    """Outgoing messages, sent within Twitch's rate limits."""
 
     CONNECTION_ATTEMPT_LIMIT = 3
     """Maximum number of connection attempts before giving up."""
     CONNECTION_ATTEMPT_TIMER = 5
     """Time between connection attempts, in seconds."""
+    JOIN_INTERVAL = 0.6
+    """Time between joining each channel, in seconds. Twitch allows 20 joins per 10 seconds."""
+    PIPELINE_WORKERS = 4
+    """Amount of messages per channel that may be handled at once."""
+    PIPELINE_QUEUE_SIZE = 100
+    """Maximum amount of messages per channel waiting to be handled before new ones are dropped."""
 
-    def __init__(
-        self, auth: TwitchOAuth2Helper, channel_name: str, channel_id: int = None
-    ):
-        """Create a new `TwitchBot`.
+    def __init__(self, auth: TwitchOAuth2Helper):
+        """Create a new `TwitchIRC`.
 
         :param auth: The Authentication object to use.
-        :param channel_name: The channel name. Channel ID is resolved in `__init__`.
         """
-        self.__joined = False
+        self.__welcomed = False
         self.__connection_tries = 0
 
-        # Grab channels
-        self.channel_name = channel_name
-        self.channel = f"#{channel_name}"
-
-        # Initialize authentication
         self.auth = auth
-        logging.info(f"Starting as {self.auth.user_id}...")
-
-        # Import channel info
-        self.channel_id = channel_id
-        if not channel_id:
-            self.channel_id = self.auth.get_user_id(channel_name)
-
-        self.user_id = self.channel_id
-        if channel_name != self.auth.user_id:
-            self.user_id = self.auth.get_user_id(self.auth.user_id)
+        self.bots = {}
 
-        self.cfg_handler = ConfigHandler(
-            f"{self.channel_id}/config.txt", DEFAULT_CHANNEL
+        # Messages are read on the IRC thread and handled on the pipeline's event loop
+        self.pipeline = MessagePipeline(
+            self.__handle, self.PIPELINE_WORKERS, self.PIPELINE_QUEUE_SIZE
         )
-        self.reload()
+        self.pipeline.start()
+
+        self.send_queue = SendQueue(self.__privmsg)
 
         self.attempt_connect()
 
@@ -73,7 +67,7 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             )
             self.__del__()
 
-        if not self.__joined:
+        if not self.__welcomed:
             # Create IRC bot connection
             server = "irc.twitch.tv"
             port = 80
@@ -88,8 +82,189 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             self.__connection_tries += 1
             Timer(self.CONNECTION_ATTEMPT_TIMER, function=self.attempt_connect).start()
 
+    def add_bot(self, bot):
+        """Handle messages for `bot.channel` with `bot`, joining it if already connected.
+
+        :param bot: The `TwitchBot` to add.
+        """
+        self.bots[bot.channel] = bot
+
+        # The broadcaster always has moderator rate limits in their own channel
+        if bot.channel_name == self.auth.user_id:
+            self.send_queue.set_moderator(bot.channel, True)
+
+        if self.__welcomed:
+            self.connection.join(bot.channel)
+
+    def remove_bot(self, bot):
+        """Stop handling messages for `bot.channel`, leaving it if connected.
+
+        :param bot: The `TwitchBot` to remove.
+        """
+        if self.bots.get(bot.channel, None) is not bot:
+            return
+
+        del self.bots[bot.channel]
+        self.pipeline.remove(bot.channel)
+
+        if self.__welcomed:
+            self.connection.part(bot.channel)
+
+    def __del__(self):
+        """Teardown every channel in preparation for closing."""
+        for bot in list(self.bots.values()):
+            bot.__del__()
+
+        if hasattr(self, "pipeline"):
+            self.pipeline.stop()
+
+        self.auth.close()
+
+        write_behind.flush()
+
+    def on_welcome(self, c, e):
+        # You must request specific capabilities before you can use them
+        c.cap("REQ", ":twitch.tv/membership")
+        c.cap("REQ", ":twitch.tv/tags")
+        c.cap("REQ", ":twitch.tv/commands")
+
+        # Space out joins to stay within the join rate limit
+        for i, channel in enumerate(list(self.bots)):
+            self.reactor.scheduler.execute_after(
+                i * self.JOIN_INTERVAL, lambda channel=channel: c.join(channel)
+            )
+
+        self.__welcomed = True
+
+    def on_join(self, c, e):
+        bot = self.bots.get(e.target, None)
+        if not bot:
+            return
+
+        bot.presence.join(e.source.nick)
+
+        if e.source.nick == self.auth.user_id:
+            logging.info(f"Joined {bot.channel}! ({bot.channel_id})\n")
+
+    def on_part(self, c, e):
+        bot = self.bots.get(e.target, None)
+        if bot:
+            bot.presence.part(e.source.nick)
+
+    def on_userstate(self, c, e):
+        # Sent on join and after each message; tells us if we have moderator rate limits
+        if e.target not in self.bots:
+            return
+
+        tags = {i["key"]: i["value"] for i in e.tags}
+        badges = tags.get("badges", None) or ""
+        self.send_queue.set_moderator(
+            e.target,
+            tags.get("mod", "0") == "1" or "broadcaster/" in badges,
+        )
+
+    def on_pubmsg(self, c, e):
+        bot = self.bots.get(e.target, None)
+        if not bot:
+            return
+
+        message = bot.create_message(e)
+
+        # Hand off to the pipeline so slow modules don't hold up reading chat,
+        # or other channels; each channel gets its' own workers
+        self.pipeline.submit((bot, message), bot.channel)
+
+    async def __handle(self, item):
+        bot, message = item
+        await bot.handle_message(message)
+
+    def send_message(self, channel: str, msg: str):
+        """Queues a message to be sent to a channel.
+
+        Messages longer than Twitch allows are split, and duplicates of recent messages are dropped.
+
+        :param channel: The channel to send to, as `#channel`.
+        :param msg: The message to send.
+        """
+        self.send_queue.put(channel, msg)
+
+    def __privmsg(self, channel: str, msg: str):
+        self.connection.privmsg(channel, msg)
+
+
+class TwitchBot:
+    auth: TwitchOAuth2Helper
+    irc: TwitchIRC
+    """The chat connection this channel is joined through."""
+    channel_id: int
+    channel_name: str
+    channel: str
+    presence: ChatterPresence
+    """Who is in this channel's chat."""
+    stream: StreamState
+    """Whether this channel is live, and its' title and game, kept up to date in the background."""
+    commands_handler: CommandsHandler
+    modules_handler: ModulesHandler
+    cfgpath: str
+    """Path to the currently used channel config file."""
+    prefix: str
+    always_import_list: list
+    """List of modules to always import, regardless of whether they're used in commands."""
+
+    def __init__(
+        self,
+        auth: TwitchOAuth2Helper,
+        channel_name: str,
+        channel_id: int = None,
+        irc: TwitchIRC = None,
+    ):
+        """Create a new `TwitchBot`.
+
+        :param auth: The Authentication object to use.
+        :param channel_name: The channel name. Channel ID is resolved in `__init__`.
+        :param irc: The chat connection to join through, shared with other channels. Creates its' own if `None`.
+        """
+        # Grab channels
+        self.channel_name = channel_name.lower()
+        self.channel = f"#{self.channel_name}"
+
+        # Initialize authentication
+        self.auth = auth
+        logging.info(f"Starting {self.channel} as {self.auth.user_id}...")
+
+        # Import channel info
+        self.channel_id = channel_id
+        if not channel_id:
+            self.channel_id = self.auth.get_user_id(self.channel_name)
+
+        self.user_id = self.channel_id
+        if self.channel_name != self.auth.user_id:
+            self.user_id = self.auth.get_user_id(self.auth.user_id)
+
+        self.presence = ChatterPresence(self.auth, self.channel_id, self.user_id)
+
+        self.stream = StreamState(self.auth, self.channel_id)
+        self.stream.start()
+
+        self.cfg_handler = ConfigHandler(
+            f"{self.channel_id}/config.txt", DEFAULT_CHANNEL
+        )
+        self.reload()
+
+        if not irc:
+            irc = TwitchIRC(auth)
+        self.irc = irc
+        self.irc.add_bot(self)
+
+    def start(self):
+        """Connect to chat and start handling messages. Blocks until disconnected."""
+        self.irc.start()
+
     def reload(self):
-        """Reload the config for the current channel."""
+        """Reload the config for the current channel.
+
+        Modules already imported are created again, but only imported again if their code has changed since.
+        """
         logging.info(f"Reading config from {self.cfg_handler._path}...")
         cfg = self.cfg_handler.read()
 
@@ -98,7 +273,10 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
 
         # Instantiate handler modules
         self.commands_handler = CommandsHandler(self)
-        self.modules_handler = ModulesHandler(self)
+        if not hasattr(self, "modules_handler"):
+            self.modules_handler = ModulesHandler(self)
+        else:
+            self.modules_handler.reload()
 
         # Import commands from config
         for name, command in cfg["commands"].items():
@@ -118,11 +296,13 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         self.always_import_list = cfg["modules"]
         if cfg["modules"]:
             for module in cfg["modules"]:
-                if module in self.modules_handler.modules:
+                # these are always created straight away, even if a command imported them already
+                if self.modules_handler.has(module):
+                    self.modules_handler.get(module)
                     continue
 
                 try:
-                    self.modules_handler.add(module)
+                    self.modules_handler.add(module, lazy=False)
                 except ModuleNotFoundError as mod:
                     logging.error(
                         f"always_import_list ('modules' in config) contains non-existent module '{mod}'"
@@ -130,8 +310,20 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
 
             logging.info(f"Imported {len(cfg['modules'])} additional module(s)")
 
+        # Unimport anything no longer used by a command or the always import list
+        used = set(self.always_import_list)
+        for command in self.commands_handler.commands.values():
+            used.update(command.get_used_modules())
+
+        for module in self.modules_handler.names():
+            if module not in used:
+                self.modules_handler.delete(module)
+
     def save(self):
-        """Write this bots' config file. For easy use within modules."""
+        """Write this bots' config file. For easy use within modules.
+
+        The write is deferred and coalesced with any other changes made shortly after.
+        """
         # Construct skeleton
         data = {
             "meta": {"prefix": self.prefix},
@@ -143,28 +335,29 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         for name, command in self.commands_handler.commands.items():
             data["commands"][name] = command.jsonify()
 
-        self.cfg_handler.write(data)
+        self.cfg_handler.write_later(data)
 
     def __del__(self):
         """Teardown all modules in preparation for closing."""
-        modules = [k for k in self.modules_handler.modules.keys()]
-        for module in modules:
+        for module in self.modules_handler.names():
             self.modules_handler.delete(module)
 
-        del self
+        if hasattr(self, "stream"):
+            self.stream.stop()
 
-    def on_welcome(self, c, e):
-        # You must request specific capabilities before you can use them
-        c.cap("REQ", ":twitch.tv/membership")
-        c.cap("REQ", ":twitch.tv/tags")
-        c.cap("REQ", ":twitch.tv/commands")
-        c.join(f"{self.channel}")
+        if hasattr(self, "irc"):
+            self.irc.remove_bot(self)
 
-        self.__joined = True
-        logging.info(f"Joined {self.channel}! ({self.channel_id})\n")
+        write_behind.flush()
 
-    def on_pubmsg(self, c, e):
-        """Code to be run when a message is sent."""
+        del self
+
+    def create_message(self, e) -> Message:
+        """Create a `Message` from a public message event in this channel.
+
+        :param e: The `pubmsg` event.
+        :return: The message.
+        """
         # Recomprehend tags into something usable
         e.tags = {i["key"]: i["value"] for i in e.tags}
 
@@ -187,22 +380,29 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
 
         # Create message object
         msg: str = e.arguments[0].replace(" \U000e0000", "")
-        message = Message(author, msg, e)
+        return Message(author, msg, e)
+
+    async def handle_message(self, message: Message):
+        """Run modules and commands for `message`. Runs on the pipeline's event loop.
+
+        :param message: The message to handle.
+        """
+        msg = message.text_raw
+        author = message.author
+        name = author.name
 
         try:
             # Don't continue if the message doesn't start with the prefix.
-            if not msg.startswith(self.prefix):
-                self.modules_handler.do_on_pubmsg(message)
+            parsed = self.commands_handler.parse(msg)
+            if not parsed:
+                await self.modules_handler.do_on_pubmsg(message)
                 return
 
-            split = msg.split(" ")
-
-            # Isolating command and command arguments
-            cmd = split[0][len(self.prefix) :].lower()
-            args = split[1:]
+            # Isolating command and command arguments; arguments are only split if used
+            cmd, args = parsed
             message.attach_command(cmd, args)
 
-            self.modules_handler.do_on_pubmsg(message)
+            await self.modules_handler.do_on_pubmsg(message)
 
             # Verify that it's actually a command before continuing.
             if cmd not in self.commands_handler.commands:
@@ -213,9 +413,9 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
 
             # Run the command and string result message
             logging.info(
-                f"Running command call '{cmd}' from {name} ({status_from_user_privilege(author.priv)}) (args:{message.args})"
+                f"Running command call '{cmd}' from {name} ({status_from_user_privilege(author.priv)}) (args:{args})"
             )
-            cmdresult = self.commands_handler.run(cmd, message)
+            cmdresult = await self.commands_handler.run(cmd, message)
 
             # If there is a string result message, print it to chat
             if cmdresult:
@@ -234,4 +434,4 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
 
         :param msg: The message to send.
         """
-        self.connection.privmsg(self.channel, f"{msg}")
+        self.irc.send_message(self.channel, f"{msg}")
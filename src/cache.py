@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import threading
+import time
+
+_MISSING = object()
+"""Sentinel for a missing or expired entry."""
+
+
+class _Flight:
+    """A load in progress for a key of a `TTLCache`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """A thread-safe, size-bounded cache whose entries expire after a time-to-live.
+
+    Least recently used entries are evicted first once `maxsize` is reached.
+    """
+
+    maxsize: int
+    """Maximum amount of entries to hold."""
+
+    def __init__(self, maxsize: int = 256):
+        """Create a new `TTLCache`.
+
+        :param maxsize: Maximum amount of entries to hold before evicting the least recently used.
+        """
+        self.maxsize = maxsize
+
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value stored for `key`, if it has not expired.
+
+        :param key: The key to look up.
+        :param default: What to return if `key` is missing or expired.
+
+        :return: The value stored for `key`, or `default`.
+        """
+        with self._lock:
+            return self.__get(key, default)
+
+    def __get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if not entry:
+            return default
+
+        expiry, value = entry
+        if expiry is not None and expiry <= time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Store `value` for `key`.
+
+        :param key: The key to store `value` under.
+        :param value: The value to store.
+        :param ttl: How long `value` is valid for, in seconds. Never expires if `None`.
+        """
+        with self._lock:
+            self.__set(key, value, ttl)
+
+    def __set(self, key, value, ttl: float = None):
+        expiry = None if ttl is None else time.monotonic() + ttl
+
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key` from the cache if it is present.
+
+        :param key: The key to remove.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, loader, ttl: float = None):
+        """Get the value stored for `key`, calling `loader()` to get and store it if missing or expired.
+
+        Concurrent misses for the same key share a single call to `loader()`.
+        Falsy results are returned to every waiter but not stored, so failed lookups are retried next time.
+
+        :param key: The key to look up.
+        :param loader: Function taking no arguments that returns the value for `key`.
+        :param ttl: How long a loaded value is valid for, in seconds. Never expires if `None`.
+
+        :return: The value for `key`.
+        """
+        with self._lock:
+            value = self.__get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        # Someone else is already loading this key; wait for their result
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                if flight.value:
+                    self.__set(key, flight.value, ttl)
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.value
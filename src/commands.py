@@ -1,11 +1,19 @@
 import logging
-import re
 import time
 
 from src.definitions import Author, Message, NO_MESSAGE_SIGNAL
+from src.stats import stats
+from src.template import split_template
 
-MODULE_MENTION_RE = re.compile(r"(%([\/a-z0-9_]+)%)")
-"""Regex to search command responses with to apply modules."""
+
+def compile_response(response: str) -> list[tuple[bool, str]]:
+    """Split `response` into literal text and module mentions.
+
+    :param response: The command response to compile.
+    :return: A list of `(is_module, value)` pairs, where `value` is either literal text,
+    a module name, or `module:field` for a field of a module.
+    """
+    return split_template(response)
 
 
 class Command:
@@ -15,6 +23,10 @@ class Command:
     privilege: int
     hidden: bool
     """Whether this command is hidden from the `help` module."""
+    aliases: list[str]
+    """Other names this command can be called by."""
+    segments: list[tuple[bool, str]]
+    """`response` compiled into `(is_module, value)` pairs of literal text and module mentions."""
 
     def __init__(
         self,
@@ -29,8 +41,9 @@ class Command:
         self.name = name.lower()
 
         self.cooldown = command["cooldown"]
-        self.response = command["response"]
         self.hidden = command["hidden"]
+        self.aliases = [alias.lower() for alias in command.get("aliases", [])]
+        self.set_response(command["response"])
 
         # convert legacy requires_mod into new privilege system
         if "requires_mod" in command:
@@ -44,18 +57,38 @@ class Command:
 
         self._last_used = 0
 
+    def set_response(self, response: str) -> None:
+        """Set `self.response` and compile it into `self.segments`.
+
+        :param response: The new response for this command.
+        """
+        self.response = response
+        self.segments = compile_response(response)
+
     def get_used_modules(self) -> list:
         """Get the list of modules that are mentioned in `self.response`.
 
         :return: The list of modules used.
         """
-        return [m[1] for m in MODULE_MENTION_RE.findall(self.response)]
+        return [value.split(":")[0] for is_module, value in self.segments if is_module]
+
+    def get_used_fields(self) -> list[tuple[str, str]]:
+        """Get the list of module fields that are mentioned in `self.response`.
+
+        :return: The list of `(module, field)` pairs used.
+        """
+        return [
+            tuple(value.split(":", 1))
+            for is_module, value in self.segments
+            if is_module and ":" in value
+        ]
 
     def jsonify(self) -> dict:
         return {
             "cooldown": self.cooldown,
             "privilege": self.privilege,
             "hidden": self.hidden,
+            "aliases": self.aliases,
             "response": self.response,
         }
 
@@ -63,13 +96,54 @@ class Command:
 class CommandsHandler:
     commands: dict[str, Command]
     """List of available commands."""
+    aliases: dict[str, str]
+    """Index of command aliases to the name of the command they call."""
 
     def __init__(self, bot):
         self.bot = bot
         self.commands = {}
+        self.aliases = {}
 
     def get(self, name: str) -> Command | None:
-        return self.commands.get(name, None)
+        return self.commands.get(self.resolve_name(name), None)
+
+    def resolve_name(self, name: str) -> str:
+        """Resolve `name` to the name of the command it calls, if it is an alias.
+
+        :param name: The command name or alias, in lowercase.
+        :return: The name of the command, or `name` if it is not an alias.
+        """
+        if name in self.commands:
+            return name
+
+        return self.aliases.get(name, name)
+
+    def parse(self, text: str) -> tuple[str, str] | None:
+        """Find the command called in `text`, without splitting the rest of it.
+
+        :param text: The raw text of a message.
+        :return: The command name (aliases resolved) and the raw text of its' arguments,
+        or `None` if `text` does not start with the prefix.
+        """
+        prefix = self.bot.prefix
+        if not text.startswith(prefix):
+            return None
+
+        start = len(prefix)
+        end = text.find(" ", start)
+        if end == -1:
+            return self.resolve_name(text[start:].lower()), ""
+
+        return self.resolve_name(text[start:end].lower()), text[end + 1 :]
+
+    def __index_aliases(self, command: Command) -> None:
+        """Point every alias of `command` to it, removing any aliases that no longer apply."""
+        for alias, name in list(self.aliases.items()):
+            if name == command.name:
+                del self.aliases[alias]
+
+        for alias in command.aliases:
+            self.aliases[alias] = command.name
 
     def add(
         self,
@@ -84,15 +158,26 @@ class CommandsHandler:
         """
         logging.debug(f"adding {name} ({command})")
 
+        new_command = Command(name, command)
+
         # Resolve any modules the command mentions and import new ones
-        for _, module in MODULE_MENTION_RE.findall(command["response"]):
-            if module not in self.bot.modules_handler.modules:
+        for module in new_command.get_used_modules():
+            if not self.bot.modules_handler.has(module):
                 try:
                     self.bot.modules_handler.add(module)
                 except ModuleNotFoundError as err:
                     raise err
 
-        self.commands[name] = Command(name, command)
+        # Check mentioned fields now rather than every time the command is run
+        for module, field in new_command.get_used_fields():
+            module_class = self.bot.modules_handler.get_class(module)
+            if field not in module_class.template_fields:
+                logging.error(
+                    f"command '{name}' uses non-existent field '{field}' of module '{module}'"
+                )
+
+        self.commands[name] = new_command
+        self.__index_aliases(new_command)
 
     def modify(self, name: str, key: str, value) -> None:
         """Modify `key` for `name`.
@@ -106,7 +191,7 @@ class CommandsHandler:
             self.commands[name].cooldown = value
 
         elif key == "response":
-            self.commands[name].response = value
+            self.commands[name].set_response(value)
 
         elif key == "privilege":
             self.commands[name].privilege = value
@@ -114,6 +199,10 @@ class CommandsHandler:
         elif key == "hidden":
             self.commands[name].hidden = value
 
+        elif key == "aliases":
+            self.commands[name].aliases = [alias.lower() for alias in value]
+            self.__index_aliases(self.commands[name])
+
         else:
             raise ValueError(f"{key} is not a valid field to modify")
 
@@ -123,14 +212,18 @@ class CommandsHandler:
         :param name: The name of the command.
         """
         logging.debug(f"removing {name}")
+        for alias in self.commands[name].aliases:
+            if self.aliases.get(alias, None) == name:
+                del self.aliases[alias]
+
         del self.commands[name]
 
-    def run(self, command: str, message: Message) -> str | None:
+    async def run(self, command: str, message: Message) -> str | None:
         """Code to be run when this command is called from chat.
 
         Runs all %% codes found in the command and returns the result.
         """
-        command: Command = self.commands.get(command, None)
+        command: Command = self.get(command)
         if not command:
             return None
 
@@ -142,21 +235,35 @@ class CommandsHandler:
         if message.author.priv < command.privilege:
             return None
 
-        # Apply the main function for any modules found
-        returned_response = command.response
-        for mention, module in MODULE_MENTION_RE.findall(returned_response):
-            returned_response = returned_response.replace(
-                mention, str(self.bot.modules_handler.run(module, message))
-            )
+        # claim the cooldown before awaiting anything, so other pipeline workers
+        # running the same command in the meantime see it; give it back if nothing is sent
+        last_used = command._last_used
+        command._last_used = time.time()
+
+        # Apply the main function for any modules found, in order,
+        # so arguments are consumed predictably
+        try:
+            with stats.timed("command", command.name, self.bot.channel_name):
+                rendered = []
+                for is_module, value in command.segments:
+                    if is_module:
+                        value = str(await self.bot.modules_handler.run(value, message))
+                    rendered.append(value)
+                returned_response = "".join(rendered)
+
+        except BaseException:
+            command._last_used = last_used
+            raise
 
         if NO_MESSAGE_SIGNAL in returned_response:
+            command._last_used = last_used
             return None
 
-        command._last_used = time.time()
         return returned_response
 
     def find_first_command_using_module(self, module: str) -> Command:
         for command in self.commands.values():
-            if module in command.get_used_modules():
+            # only count the module being run, not just its' fields being used
+            if (True, module) in command.segments:
                 return command
         return None
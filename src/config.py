@@ -1,5 +1,10 @@
+import atexit
+import copy
 import logging
 import os
+import tempfile
+import threading
+import traceback
 import yaml
 
 BASE_CONFIG_PATH = "userdata"
@@ -46,11 +51,90 @@ DEFAULT_CHANNEL = {
 DEFAULT_GLOBAL = {
     "default_authfile": "auth.txt",
     "release_branch": "main",
+    # Channels to join if none are given with --channel. Joins your own if empty.
+    "channels": [],
+    # Port to serve Prometheus metrics on at http://localhost:<port>/metrics. 0 to disable.
+    "metrics_port": 0,
 }
 
+WRITE_BEHIND_DELAY = 2
+"""Time to wait after a config is marked for writing before writing it, in seconds.
+
+Any further changes within this time are written together with it.
+"""
+
+# tempfile creates files only we can read; new configs should get the usual permissions instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 read_global = lambda: ConfigHandler(GLOBAL_CONFIG_FILE, DEFAULT_GLOBAL).read()
 
 
+class WriteBehind:
+    """Coalesces config writes and performs them on a timer, off the calling thread."""
+
+    delay: float
+    """Time to wait after the first pending write before flushing, in seconds."""
+
+    def __init__(self, delay: float = WRITE_BEHIND_DELAY):
+        """Create a new `WriteBehind`.
+
+        :param delay: Time to wait after the first pending write before flushing, in seconds.
+        """
+        self.delay = delay
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def schedule(self, handler, cfg: dict):
+        """Mark `cfg` to be written by `handler`, replacing any write pending for the same path.
+
+        :param handler: The `ConfigHandler` to write `cfg` with.
+        :param cfg: The `dict` to write. Copied now, so later changes to it aren't written half-done.
+        """
+        # the caller may keep changing cfg while the timer thread writes it
+        cfg = copy.deepcopy(cfg)
+
+        with self._lock:
+            self._pending[handler._path] = (handler, cfg)
+
+            if not self._timer:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, path: str = None):
+        """Write pending configs now.
+
+        :param path: Only write the config pending for this path. Writes all pending if `None`.
+        """
+        with self._lock:
+            if path:
+                pending = [self._pending.pop(path)] if path in self._pending else []
+            else:
+                pending = list(self._pending.values())
+                self._pending.clear()
+
+            if not self._pending and self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+        for handler, cfg in pending:
+            try:
+                handler.write(cfg)
+            except Exception:
+                logging.error(f"failed to write {handler._path}:")
+                logging.error(traceback.format_exc())
+
+
+write_behind = WriteBehind()
+"""Shared `WriteBehind` used by every `ConfigHandler`."""
+
+# Make sure nothing pending is lost when closing
+atexit.register(write_behind.flush)
+
+
 class ConfigHandler:
     def __init__(self, path: str, default: dict):
         self._default_config = default
@@ -85,6 +169,9 @@ class ConfigHandler:
 
         :return: The resulting config
         """
+        # Don't read an outdated file if a write is still pending
+        write_behind.flush(self._path)
+
         try:
             logging.debug(f"reading {self._path}")
             with open(self._path, "r") as cfgfile:
@@ -148,10 +235,44 @@ class ConfigHandler:
     def write(self, cfg: dict):
         """Write `cfg` to `self._path` and return `cfg`.
 
+        Writes to a temporary file first and replaces `self._path` with it,
+        so a crash mid-write can't leave a half-written config behind.
+
         :param cfg: The `dict` object to convert to json and write
         """
-        with open(self._path, "w") as cfgfile:
-            logging.debug(f"writing {self._path}")
-            cfgfile.write(yaml.safe_dump(cfg, indent=4))
+        data = yaml.safe_dump(cfg, indent=4)
+
+        logging.debug(f"writing {self._path}")
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(self._path) or ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as cfgfile:
+                cfgfile.write(data)
+                cfgfile.flush()
+                os.fsync(cfgfile.fileno())
 
+            # keep the permissions of the config being replaced
+            try:
+                mode = os.stat(self._path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            os.chmod(tmppath, mode)
+
+            os.replace(tmppath, self._path)
+
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+        return cfg
+
+    def write_later(self, cfg: dict):
+        """Schedule `cfg` to be written to `self._path` by `write_behind` and return `cfg`.
+
+        Repeated calls within `WRITE_BEHIND_DELAY` seconds only write once.
+
+        :param cfg: The `dict` object to convert to json and write
+        """
+        write_behind.schedule(self, cfg)
         return cfg
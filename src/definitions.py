@@ -161,10 +161,6 @@ class Message:
     """The raw message event received by `irc.bot.SingleServerIRCBot.on_pubmsg()`."""
     cmd: str
     """The command used, if applicable, in this message."""
-    args: list
-    """The list of arguments in the message.\n
-    ### Do not modify this directly!! Use `Module.get_args(message)` to get arguments in modules.
-    """
 
     def __init__(self, author: Author, text_raw: str, event: dict):
         """Create a new `Message`.
@@ -176,16 +172,37 @@ class Message:
         self.text_raw = text_raw
         self.event = event
         self.cmd = None
-        self.args = None
+        self._args = None
+        self._args_raw = None
+
+    @property
+    def args(self) -> list:
+        """The list of arguments in the message. Only split from the raw text once first needed.\n
+        ### Do not modify this directly!! Use `Module.get_args(message)` to get arguments in modules.
+        """
+        if self._args is None and self._args_raw is not None:
+            self._args = self._args_raw.split(" ") if self._args_raw else []
+            self._args_raw = None
 
-    def attach_command(self, cmd: str = "", args: list = []):
+        return self._args
+
+    @args.setter
+    def args(self, args: list):
+        self._args = args
+        self._args_raw = None
+
+    def attach_command(self, cmd: str = "", args: list | str = []):
         """Attach command information to this `Message`.
 
         :param cmd: The command the `Author` called.
-        :param args: The list of args the `Author` provided.
+        :param args: The list of args the `Author` provided, or the raw text following the command to split when needed.
         """
         self.cmd = cmd
-        self.args = args
+        if isinstance(args, str):
+            self._args = None
+            self._args_raw = args
+        else:
+            self.args = args
 
     def consume(self, amount: int = 0):
         """Consume `amount` arguments, removing them from `self.args` and returning them.
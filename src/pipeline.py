@@ -0,0 +1,129 @@
+import asyncio
+import inspect
+import logging
+from threading import Thread
+import traceback
+
+
+async def call(func, *args, **kwargs):
+    """Call `func` without blocking the event loop.
+
+    Coroutine functions are awaited directly; anything else is run in the loop's default executor.
+
+    :param func: The function to call.
+    :return: Whatever `func` returns.
+    """
+    if inspect.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+class MessagePipeline:
+    """An asyncio event loop on its own thread that feeds submitted items
+    through bounded queues to a fixed number of worker tasks per queue.
+
+    Items are queued by key (e.g. per channel), each key with its' own queue and workers,
+    so slow items for one key never hold up another.
+    """
+
+    handler = None
+    """Coroutine function every submitted item is passed to."""
+    workers: int
+    """Amount of items per key that may be handled at once."""
+    maxsize: int
+    """Maximum amount of items per key waiting to be handled. Items submitted past this are dropped."""
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(self, handler, workers: int = 4, maxsize: int = 100):
+        """Create a new `MessagePipeline`.
+
+        :param handler: The coroutine function to pass every submitted item to.
+        :param workers: The amount of worker tasks to handle items with, per key.
+        :param maxsize: The maximum amount of items per key to queue before dropping new ones.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+
+        self.loop = asyncio.new_event_loop()
+        self._queues = {}
+        self._tasks = {}
+        self._thread = Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Start the event loop thread. Workers are started for each key as it is first used."""
+        self._thread.start()
+
+    def submit(self, item, key=None) -> None:
+        """Queue `item` to be handled. Safe to call from any thread.
+
+        :param item: The item to pass to `self.handler`.
+        :param key: The queue to put `item` on, e.g. its' channel.
+        """
+        self.loop.call_soon_threadsafe(self.__put, item, key)
+
+    def __put(self, item, key):
+        queue = self._queues.get(key, None)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue(self.maxsize)
+            self._tasks[key] = [
+                asyncio.create_task(self.__worker(queue)) for _ in range(self.workers)
+            ]
+
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logging.warning(
+                f"message pipeline for {key} full ({self.maxsize}); dropping message"
+            )
+
+    def remove(self, key) -> None:
+        """Stop the workers for `key`, dropping anything still queued for it. Safe to call from any thread.
+
+        :param key: The queue to remove.
+        """
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.__remove, key)
+
+    def __remove(self, key):
+        self._queues.pop(key, None)
+        for task in self._tasks.pop(key, []):
+            task.cancel()
+
+    async def __worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await self.handler(item)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                queue.task_done()
+
+    def run(self, coro, timeout: float = None):
+        """Run `coro` on the event loop from another thread and wait for its' result.
+
+        :param coro: The coroutine to run.
+        :param timeout: How long to wait for the result, in seconds. Waits forever if `None`.
+        :return: The result of `coro`.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        """Cancel all workers and stop the event loop."""
+        if not self.loop.is_running():
+            return
+
+        asyncio.run_coroutine_threadsafe(self.__stop_workers(), self.loop)
+
+    async def __stop_workers(self):
+        tasks = [task for tasks in self._tasks.values() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
@@ -1,13 +1,63 @@
+import asyncio
+from concurrent.futures import Future
 from importlib.util import spec_from_file_location, module_from_spec
 import logging
+import os
+import re
+import sys
 import threading
 import traceback
 
 from src.config import ConfigHandler
 from src.definitions import Message
+from src.pipeline import call
+from src.scheduler import Job, scheduler
+from src.stats import stats
 
+_module_code = {}
+"""Imported module code, shared by every channel, as `name: (mtime, module)`."""
+_module_code_lock = threading.Lock()
 
-class BaseModule(threading.Thread):
+
+def load_module_code(name: str):
+    """Import the code for module `name`, reusing the last import if the file hasn't changed since.
+
+    The code is registered in `sys.modules` as `modules.<name>`, so regular imports of it share the same code.
+
+    :param name: The path to the module. Path is relative to the `modules` folder.
+    :return: The imported Python module.
+    """
+    path = f"modules/{name}.py"
+    mtime = os.path.getmtime(path)
+
+    with _module_code_lock:
+        cached = _module_code.get(name, None)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        # Create spec and import from directory; bytecode is cached in __pycache__ as usual.
+        qualname = f"modules.{name.replace('/', '.')}"
+        spec = spec_from_file_location(qualname, path)
+        module = module_from_spec(spec)
+
+        previous = sys.modules.get(qualname, None)
+        sys.modules[qualname] = module
+        try:
+            spec.loader.exec_module(module)
+
+        except BaseException:
+            # don't leave a half-imported module behind
+            if previous:
+                sys.modules[qualname] = previous
+            else:
+                del sys.modules[qualname]
+            raise
+
+        _module_code[name] = (mtime, module)
+        return module
+
+
+class BaseModule:
     """The base class for a Module.
 
     Facilitates defaults for a Module so as to prevent errors.
@@ -22,14 +72,31 @@ class BaseModule(threading.Thread):
     consumes = 0
     """How many message arguments to consume. Any negative value for all remaining."""
 
+    on_pubmsg_filter: str | re.Pattern = None
+    """Only run `on_pubmsg` for messages containing this string or matching this compiled regex. Runs for all messages if `None`."""
+
+    on_pubmsg_timeout = 10
+    """Maximum time `on_pubmsg` may take for one message, in seconds, before it is no longer waited on."""
+
+    template_fields = {}
+    """Fields of this module that command responses can use as `%module:field%`. See `render_field`."""
+
+    lazy = True
+    """Whether to wait until this module is first used to create it. Modules that override `on_pubmsg` are always created straight away.
+
+    Set to `False` if the module needs to start work (e.g. `schedule_every`) as soon as it is imported."""
+
     def __init__(self, bot, name: str):
         """Initialize a module. If a `cfgdefault` is given,
         it will drop the given default into the user's config directory.
         """
-        threading.Thread.__init__(self)
         self._bot = bot
         self._name = name
 
+        self._jobs = []
+        self._futures = []
+        self._threads = []
+
         self._cfghandler = ConfigHandler(
             f"{self._bot.channel_id}/modules/{name}.txt", self.default_config
         )
@@ -39,17 +106,110 @@ class BaseModule(threading.Thread):
     def __del__(self):
         """Destroy this module. Does nothing by default.
 
-        Used in `xp` to teardown the thread for faster closing through Ctrl+C.
+        Background tasks are stopped by `stop_background_tasks()` separately, so this doesn't need to.
         """
         pass
 
+    def schedule_every(self, interval: float, func, *args) -> Job:
+        """Run `func(*args)` every `interval` seconds on the shared worker pool until this module is unimported.
+
+        :param interval: Time between runs, in seconds.
+        :param func: The function to run.
+        :return: The scheduled `Job`. Call `cancel()` on it to stop it early.
+        """
+        self._jobs = [j for j in self._jobs if not j.done()]
+
+        job = scheduler.every(interval, func, *args)
+        self._jobs.append(job)
+        return job
+
+    def schedule_after(self, delay: float, func, *args) -> Job:
+        """Run `func(*args)` once after `delay` seconds on the shared worker pool, unless this module is unimported first.
+
+        :param delay: Time to wait before running, in seconds.
+        :param func: The function to run.
+        :return: The scheduled `Job`. Call `cancel()` on it to stop it early.
+        """
+        self._jobs = [j for j in self._jobs if not j.done()]
+
+        job = scheduler.after(delay, func, *args)
+        self._jobs.append(job)
+        return job
+
+    def run_in_background(self, func, *args) -> Future:
+        """Run `func(*args)` on the shared worker pool as soon as possible.
+
+        Use for short jobs; use `start_thread()` for anything that runs for the module's lifetime.
+
+        :param func: The function to run.
+        :return: The `Future` for the result of `func`.
+        """
+        self._futures = [f for f in self._futures if not f.done()]
+
+        future = scheduler.submit(func, *args)
+        self._futures.append(future)
+        return future
+
+    def start_thread(self, func, *args, stop=None) -> threading.Thread:
+        """Run `func(*args)` on a dedicated daemon thread, for work that runs for the module's lifetime.
+
+        These are waited on when the module is unimported, after `__del__`;
+        make `func` return from `__del__`, or pass `stop`.
+
+        :param func: The function to run.
+        :param stop: Function taking no arguments that makes `func` return, called when the module is unimported.
+        :return: The started thread.
+        """
+        thread = threading.Thread(target=func, args=args, daemon=True)
+        thread.start()
+        self._threads.append((thread, stop))
+        return thread
+
+    def stop_background_tasks(self, timeout: float = 5):
+        """Cancel this module's scheduled jobs and pending background work, stop its' threads,
+        and wait for anything running to finish.
+
+        :param timeout: Maximum time to wait for each running task, in seconds.
+        """
+        for job in self._jobs:
+            job.cancel()
+        for future in self._futures:
+            future.cancel()
+        for thread, stop in self._threads:
+            if stop:
+                try:
+                    stop()
+                except Exception:
+                    self.log_e(f"failed to stop thread {thread.name}:")
+                    self.log_e(traceback.format_exc())
+
+        for job in self._jobs:
+            job.join(timeout)
+        for future in self._futures:
+            if not future.cancelled():
+                try:
+                    future.result(timeout)
+                except Exception:
+                    pass
+        for thread, _ in self._threads:
+            thread.join(timeout)
+            if thread.is_alive():
+                self.log_w(f"thread {thread.name} still running after {timeout}s")
+
+        self._jobs.clear()
+        self._futures.clear()
+        self._threads.clear()
+
     def reload_config(self):
         """Completely reload this module's config from file."""
         self._cfg = self._cfghandler.read()
 
     def save_config(self):
-        """Save the current form of this module's `self.cfg` attribute to file."""
-        self._cfghandler.write(self._cfg)
+        """Save the current form of this module's `self.cfg` attribute to file.
+
+        The write is deferred and coalesced with any other changes made shortly after.
+        """
+        self._cfghandler.write_later(self._cfg)
 
     def cfg_get(self, key: str):
         """Read the given config dict key. If it fails to read it will fill it in with the default.
@@ -77,24 +237,52 @@ class BaseModule(threading.Thread):
     def main(self, message: Message):
         """Code to be run for the modules' %% code.
 
+        May be overridden as an `async def`; blocking overrides are run off the event loop.
+
         :return: The message to replace the message module mention with.
         """
         pass
 
-    def help(self):
+    def render_field(self, field: str, message: Message):
+        """Get the value of `field` (one of `template_fields`) for a `%module:field%` mention in a command.
+
+        :return: The message to replace the mention with.
+        """
+        pass
+
+    @classmethod
+    def help(cls):
         """The help message when used with the `help` module.
 
+        Called on the class, so modules that haven't been created yet don't have to be just to show it.
+
         :return: The message to show when used as an argument for the `help` module.
         """
-        return self.helpmsg
+        return cls.helpmsg
 
     def on_pubmsg(self, message: Message):
         """Code to be run for every message received.
 
-        By default, does nothing.
+        May be overridden as an `async def`. By default, does nothing.
         """
         pass
 
+    def wants_message(self, message: Message) -> bool:
+        """Whether `on_pubmsg` should run for `message`.
+
+        Checks `on_pubmsg_filter` by default. Keep overrides cheap, as this runs for every message.
+
+        :param message: The message received.
+        :return: `True` if `on_pubmsg` should run.
+        """
+        if self.on_pubmsg_filter is None:
+            return True
+
+        if isinstance(self.on_pubmsg_filter, str):
+            return self.on_pubmsg_filter in message.text_raw
+
+        return self.on_pubmsg_filter.search(message.text_raw) is not None
+
     def log_e(self, msg: str):
         """Log an error alongside the module's name to the window.
 
@@ -146,30 +334,76 @@ class BaseModule(threading.Thread):
 class ModulesHandler:
     modules: dict[str, BaseModule]
     """List of available modules."""
+    lazy: dict[str, type]
+    """Modules that are imported but not yet created, as `name: Module class`. See `BaseModule.lazy`."""
 
     def __init__(self, bot):
         self.bot = bot
         self.modules = {}
+        self.lazy = {}
+
+        self._code = {}
+        self._create_lock = threading.Lock()
+
+    def has(self, name: str) -> bool:
+        """Return whether module `name` is imported, whether it has been created yet or not."""
+        return name in self.modules or name in self.lazy
 
     def get(self, module: str) -> BaseModule:
-        return self.modules.get(module, None)
+        """Get module `module`, creating it first if it hasn't been yet.
+
+        :param module: The name of the module.
+        :return: The module, or `None` if it isn't imported.
+        """
+        instance = self.modules.get(module, None)
+        if instance or module not in self.lazy:
+            return instance
+
+        with self._create_lock:
+            # someone else may have created it while we waited
+            if module in self.modules:
+                return self.modules[module]
+
+            logging.debug(f"creating module {module} on first use")
+            self.modules[module] = self.lazy[module](self.bot, module)
+            del self.lazy[module]
+            return self.modules[module]
 
-    def add(self, name: str):
+    def get_class(self, name: str) -> type:
+        """Get the `Module` class of module `name`, without creating it.
+
+        :param name: The name of the module.
+        :return: The class, or `None` if the module isn't imported.
+        """
+        if name in self.lazy:
+            return self.lazy[name]
+
+        if name in self.modules:
+            return type(self.modules[name])
+
+        return None
+
+    def names(self) -> list[str]:
+        """Return the names of every imported module, whether it has been created yet or not."""
+        return list(self.modules) + list(self.lazy)
+
+    def add(self, name: str, lazy: bool = True):
         """Imports a new module and appends it to the modules dict.
 
         :param name: The path to the module. Path is relative to the `modules` folder.
+        :param lazy: Whether the module may wait until it is first used to be created. See `BaseModule.lazy`.
         """
         logging.debug(f"importing module {name}")
 
         try:
-            # Create spec and import from directory.
-            spec = spec_from_file_location(f"{name}", f"modules/{name}.py")
-            module = module_from_spec(spec)
-            spec.loader.exec_module(module)
+            code = load_module_code(name)
+            self._code[name] = code
 
-            # Give it its' own thread and start it up
-            self.modules[name] = module.Module(self.bot, name)
-            self.modules[name].start()
+            cls = code.Module
+            if lazy and cls.lazy and cls.on_pubmsg is BaseModule.on_pubmsg:
+                self.lazy[name] = cls
+            else:
+                self.modules[name] = cls(self.bot, name)
 
         except FileNotFoundError:
             raise ModuleNotFoundError(name)
@@ -181,29 +415,130 @@ class ModulesHandler:
             raise ModuleNotFoundError(name)
 
     def delete(self, name: str):
-        """Call `module.__del__()` and remove it from `modules`.
+        """Call `module.__del__()`, stop its' background tasks, and remove it from `modules`.
 
         :param name: The name of the module.
         """
         logging.debug(f"unimporting module {name}")
 
+        self._code.pop(name, None)
+
+        if name in self.lazy:
+            del self.lazy[name]
+            return
+
         if name not in self.modules:
             return
 
         self.modules[name].__del__()
+        self.modules[name].stop_background_tasks()
         del self.modules[name]
 
-    def run(self, name: str, message: Message) -> str | None:
+    def reload(self):
+        """Import modules again if their code changed since they were imported, and create the rest again.
+
+        Modules often read their config in `__init__`, so unchanged modules are created again
+        from the code already imported rather than only reloading their config.
+        """
+        for name in self.names():
+            try:
+                changed = load_module_code(name) is not self._code.get(name, None)
+
+            except Exception:
+                logging.error(
+                    f"failed to import changed module {name}; keeping the old one:"
+                )
+                logging.error(traceback.format_exc())
+                continue
+
+            if not changed:
+                if name in self.modules:
+                    self.__recreate(name)
+                continue
+
+            logging.info(f"module {name} changed; importing it again")
+            lazy = name in self.lazy
+            self.delete(name)
+            try:
+                self.add(name, lazy)
+            except ModuleNotFoundError:
+                pass
+
+    def __recreate(self, name: str):
+        """Stop module `name` and create it again from the same code.
+
+        The old module stays in `modules` until the new one is ready, so commands keep working meanwhile.
+        If creating it fails, the module is unimported.
+        """
+        logging.debug(f"creating module {name} again")
+
+        old = self.modules[name]
+        old.__del__()
+        old.stop_background_tasks()
+
+        try:
+            self.modules[name] = type(old)(self.bot, name)
+
+        except Exception:
+            logging.error(f"failed to create module {name} again with error trace:")
+            logging.error(traceback.format_exc())
+            self._code.pop(name, None)
+            del self.modules[name]
+
+    async def run(self, name: str, message: Message) -> str | None:
+        """Run the `main` of module `name` without blocking the event loop.
+
+        :param name: The name of the module, or `module:field` to render one of its' fields instead.
+        :param message: The message this is acting on.
+        """
+        name, _, field = name.partition(":")
         module: BaseModule = self.modules.get(name, None)
         if not module:
-            return None
+            if name not in self.lazy:
+                return None
+
+            # creating a module may be slow, so do it off the event loop
+            module = await asyncio.to_thread(self.get, name)
+
+        if field:
+            if field not in module.template_fields:
+                return None
+            return module.render_field(field, message)
 
-        return module.main(message)
+        with stats.timed("main", name, self.bot.channel_name):
+            return await call(module.main, message)
 
-    def do_on_pubmsg(self, message: Message):
-        """Runs the on_pubmsg() of every `Module` imported.
+    async def do_on_pubmsg(self, message: Message):
+        """Runs the on_pubmsg() of every `Module` imported that wants `message`, all at once.
+
+        A module failing or timing out is logged and does not affect the others.
 
         :param message: The message this is acting on.
         """
-        for module in self.modules.values():
-            module.on_pubmsg(message)
+        modules = [
+            module
+            for module in list(self.modules.values())
+            if type(module).on_pubmsg is not BaseModule.on_pubmsg
+            and module.wants_message(message)
+        ]
+        if not modules:
+            return
+
+        await asyncio.gather(*[self.__on_pubmsg(module, message) for module in modules])
+
+    async def __on_pubmsg(self, module: BaseModule, message: Message):
+        """Run `module.on_pubmsg(message)`, logging rather than raising any failure."""
+        try:
+            with stats.timed("on_pubmsg", module._name, self.bot.channel_name):
+                await asyncio.wait_for(
+                    call(module.on_pubmsg, message), module.on_pubmsg_timeout
+                )
+
+        except asyncio.TimeoutError:
+            module.log_w(
+                f"on_pubmsg took longer than {module.on_pubmsg_timeout}s; no longer waiting on it"
+            )
+
+        except Exception:
+            module.log_e("on_pubmsg failed with error trace:")
+            module.log_e(traceback.format_exc())
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+import traceback
+
+from src.authentication import TwitchOAuth2Helper
+
+FULL_REFRESH_INTERVAL = 300
+"""Time between fetching the full chatter list from Twitch, in seconds.
+Joins and parts seen in chat keep it up to date in between.
+
+Twitch stops sending joins and parts in channels with more than about 1000 chatters,
+so callers that need to notice people leaving can ask for a shorter interval
+for when none are arriving; see `ChatterPresence.chatters()`."""
+
+FAILED_RETRY_INTERVAL = 30
+"""Time to wait before fetching the full chatter list again after a failed fetch, in seconds."""
+
+
+class ChatterPresence:
+    """Keeps track of who is in a channel's chat, so modules can check without asking Twitch.
+
+    The full chatter list is only fetched every `FULL_REFRESH_INTERVAL` seconds;
+    joins and parts from chat are applied as they come in.
+    If none have come in since the last fetch, callers may ask for it to be fetched more often.
+    """
+
+    def __init__(self, auth: TwitchOAuth2Helper, channel_id: int, user_id: int):
+        """Create a new `ChatterPresence`.
+
+        :param auth: The Authentication object to use.
+        :param channel_id: The User ID of the channel to track.
+        :param user_id: The User ID of the bot account. Must be a moderator in the channel to fetch chatters.
+        """
+        self.auth = auth
+        self.channel_id = channel_id
+        self.user_id = user_id
+
+        self._chatters = set()
+        # when the full list was last fetched successfully, and last tried at all
+        self._updated = 0
+        self._attempted = 0
+        # when a join or part was last seen in chat
+        self._last_event = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._hooks = []
+
+    def __len__(self):
+        return len(self._chatters)
+
+    def __contains__(self, name: str) -> bool:
+        return self.is_present(name)
+
+    def is_present(self, name: str) -> bool:
+        """Return whether `name` is in chat, as of the last update.
+
+        :param name: The user login to check.
+        """
+        return name.lower() in self._chatters
+
+    def chatters(
+        self,
+        max_age: float = FULL_REFRESH_INTERVAL,
+        max_age_without_events: float = None,
+    ) -> frozenset:
+        """Return everyone in chat, fetching the full list first if it is older than `max_age`.
+
+        Twitch stops sending joins and parts in big channels, so without them the list only
+        changes on a full fetch. `max_age_without_events` trades more calls to Twitch for noticing
+        people leave sooner there; quiet channels where nobody joins or leaves pay for it too,
+        though their lists are only a page long.
+
+        :param max_age: How old the full list may be, in seconds.
+        :param max_age_without_events: How old the full list may be if no joins or parts were seen since it was fetched, in seconds.
+        Defaults to `max_age`.
+        :return: The user logins of everyone in chat.
+        """
+        if max_age_without_events is not None and self._last_event < self._updated:
+            max_age = min(max_age, max_age_without_events)
+
+        now = time.monotonic()
+        if (
+            now - self._updated > max_age
+            and now - self._attempted >= FAILED_RETRY_INTERVAL
+        ):
+            self.refresh()
+
+        with self._lock:
+            return frozenset(self._chatters)
+
+    def on_change(self, callback):
+        """Call `callback(joined, parted)` with the sets of user logins that joined or left, whenever anyone does.
+
+        :param callback: The function to call.
+        """
+        self._hooks.append(callback)
+
+    def refresh(self):
+        """Fetch the full chatter list now, and work out who joined or left since the last update.
+
+        If the fetch fails, the current list is kept as is.
+        """
+        # only one fetch at a time; anyone else waiting can use its' result
+        seen = self._attempted
+        with self._refresh_lock:
+            if self._attempted != seen:
+                return
+
+            # build the set page by page, rather than from one big list
+            try:
+                users = {
+                    user.lower()
+                    for user in self.auth.iter_chatters(self.channel_id, self.user_id)
+                }
+            except ConnectionError as err:
+                logging.debug(f"{err}; trying again in {FAILED_RETRY_INTERVAL}s")
+                users = None
+
+            self._attempted = time.monotonic()
+
+            # there's always at least the bot in chat, so nothing means the fetch failed
+            if not users:
+                return
+
+            self._updated = self._attempted
+
+            with self._lock:
+                joined = users - self._chatters
+                parted = self._chatters - users
+                self._chatters = users
+
+        self.__notify(joined, parted)
+
+    def join(self, name: str):
+        """Mark `name` as in chat.
+
+        :param name: The user login that joined.
+        """
+        self._last_event = time.monotonic()
+        name = name.lower()
+        with self._lock:
+            if name in self._chatters:
+                return
+            self._chatters.add(name)
+
+        self.__notify({name}, set())
+
+    def part(self, name: str):
+        """Mark `name` as no longer in chat.
+
+        :param name: The user login that left.
+        """
+        self._last_event = time.monotonic()
+        name = name.lower()
+        with self._lock:
+            if name not in self._chatters:
+                return
+            self._chatters.discard(name)
+
+        self.__notify(set(), {name})
+
+    def __notify(self, joined: set, parted: set):
+        if not joined and not parted:
+            return
+
+        for hook in self._hooks:
+            try:
+                hook(joined, parted)
+            except Exception:
+                logging.error(f"chatter presence hook {hook} failed:")
+                logging.error(traceback.format_exc())
@@ -0,0 +1,209 @@
+from collections import deque
+import logging
+import threading
+import time
+import traceback
+
+MESSAGE_LENGTH_LIMIT = 500
+"""Maximum length of one Twitch chat message."""
+
+
+class TokenBucket:
+    """Allows `capacity` actions per `per` seconds, refilling continuously."""
+
+    capacity: int
+    per: float
+
+    def __init__(self, capacity: int, per: float):
+        """Create a new, full `TokenBucket`.
+
+        :param capacity: Maximum amount of actions allowed at once.
+        :param per: Time for an empty bucket to refill completely, in seconds.
+        """
+        self.capacity = capacity
+        self.per = per
+
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._updated) * self.capacity / self.per,
+        )
+        self._updated = now
+
+    def wait_time(self) -> float:
+        """Get how long until an action is allowed, in seconds. 0 if allowed now."""
+        self.__refill()
+        if self._tokens >= 1:
+            return 0
+
+        return (1 - self._tokens) * self.per / self.capacity
+
+    def take(self):
+        """Use up one action."""
+        self.__refill()
+        self._tokens -= 1
+
+
+def split_message(msg: str, limit: int = MESSAGE_LENGTH_LIMIT) -> list[str]:
+    """Split `msg` into parts no longer than `limit`, preferring to split between words.
+
+    :param msg: The message to split.
+    :param limit: The maximum length of each part.
+    :return: The parts of the message.
+    """
+    parts = []
+    while len(msg) > limit:
+        cut = msg.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+
+        parts.append(msg[:cut])
+        msg = msg[cut:].lstrip(" ")
+
+    if msg:
+        parts.append(msg)
+
+    return parts
+
+
+class SendQueue:
+    """Queues chat messages per channel and sends them as fast as Twitch's rate limits allow.
+
+    Channels take turns so one busy channel can't hold up the others.
+    """
+
+    USER_LIMIT = (20, 30)
+    """Messages allowed per seconds, account-wide, in channels the bot is not a moderator in."""
+    MODERATOR_LIMIT = (100, 30)
+    """Messages allowed per seconds, account-wide, in channels the bot is a moderator or broadcaster in."""
+    USER_MESSAGE_INTERVAL = 1
+    """Minimum time between messages in a channel the bot is not a moderator in, in seconds."""
+    DUPLICATE_WINDOW = 30
+    """Identical messages to the same channel within this many seconds are dropped, as Twitch would."""
+
+    def __init__(self, send):
+        """Create a new `SendQueue`.
+
+        :param send: Function taking `(channel, msg)` that actually sends a message.
+        """
+        self.send = send
+
+        self._user_bucket = TokenBucket(*self.USER_LIMIT)
+        self._mod_bucket = TokenBucket(*self.MODERATOR_LIMIT)
+        self._moderated = set()
+        self._queues = {}
+        self._last_sent = {}
+        self._recent = {}
+
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def set_moderator(self, channel: str, is_moderator: bool):
+        """Set whether the bot is a moderator (or the broadcaster) in `channel`.
+
+        :param channel: The channel, as `#channel`.
+        :param is_moderator: Whether the bot has moderator limits in `channel`.
+        """
+        with self._cond:
+            if is_moderator:
+                self._moderated.add(channel)
+            else:
+                self._moderated.discard(channel)
+            self._cond.notify()
+
+    def put(self, channel: str, msg: str):
+        """Queue `msg` to be sent to `channel`, split into several messages if too long.
+
+        :param channel: The channel, as `#channel`.
+        :param msg: The message to send.
+        """
+        with self._cond:
+            queue = self._queues.setdefault(channel, deque())
+
+            for part in split_message(msg):
+                sent = self._recent.get((channel, part), None)
+                if part in queue or (
+                    sent and time.monotonic() - sent < self.DUPLICATE_WINDOW
+                ):
+                    logging.debug(f"dropping duplicate message to {channel}: {part}")
+                    continue
+
+                queue.append(part)
+
+            self._cond.notify()
+
+    def __wait_time(self, channel: str) -> float:
+        """Get how long until a message can be sent to `channel`, in seconds."""
+        if channel in self._moderated:
+            return self._mod_bucket.wait_time()
+
+        return max(
+            self._mod_bucket.wait_time(),
+            self._user_bucket.wait_time(),
+            self._last_sent.get(channel, 0)
+            + self.USER_MESSAGE_INTERVAL
+            - time.monotonic(),
+        )
+
+    def __take(self, channel: str):
+        """Use up the rate limit for sending a message to `channel`."""
+        now = time.monotonic()
+
+        self._mod_bucket.take()
+        if channel not in self._moderated:
+            self._user_bucket.take()
+        self._last_sent[channel] = now
+
+        # forget messages old enough to not be duplicates anymore
+        self._recent = {
+            k: t for k, t in self._recent.items() if now - t < self.DUPLICATE_WINDOW
+        }
+
+    def __next(self) -> tuple[str, str] | float:
+        """Pop the next message that can be sent now, taking turns between channels.
+
+        :return: `(channel, msg)`, or how long to wait before trying again (`None` if nothing is queued).
+        """
+        wait = None
+        for channel in list(self._queues):
+            queue = self._queues[channel]
+            if not queue:
+                continue
+
+            channel_wait = self.__wait_time(channel)
+            if channel_wait > 0:
+                wait = channel_wait if wait is None else min(wait, channel_wait)
+                continue
+
+            msg = queue.popleft()
+            self.__take(channel)
+            self._recent[(channel, msg)] = time.monotonic()
+
+            # move to the back of the line
+            del self._queues[channel]
+            if queue:
+                self._queues[channel] = queue
+
+            return channel, msg
+
+        return wait
+
+    def __run(self):
+        while True:
+            with self._cond:
+                item = self.__next()
+                while not isinstance(item, tuple):
+                    self._cond.wait(item)
+                    item = self.__next()
+
+            channel, msg = item
+            try:
+                self.send(channel, msg)
+            except Exception:
+                logging.error(f"failed to send message to {channel}:")
+                logging.error(traceback.format_exc())
@@ -0,0 +1,142 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+BACKGROUND_WORKERS = 8
+"""Amount of threads shared by every module for running background work."""
+
+
+class Job:
+    """A function scheduled to run on a `Scheduler`, once or repeatedly."""
+
+    interval: float
+    """Time between runs, in seconds, or `None` if this job only runs once."""
+    cancelled: bool
+    future: Future
+    """The future of the current or last run, or `None` if it hasn't run yet."""
+
+    def __init__(self, when: float, interval: float, func, args: tuple):
+        self.when = when
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        """Stop this job from running again. Does not interrupt a run in progress."""
+        self.cancelled = True
+
+    def done(self) -> bool:
+        """Whether this job won't run again, and isn't running now."""
+        if self.future and not self.future.done():
+            return False
+
+        return self.cancelled or (self.interval is None and self.future is not None)
+
+    def join(self, timeout: float = None):
+        """Wait for a run in progress to finish.
+
+        :param timeout: Maximum time to wait, in seconds. Waits forever if `None`.
+        """
+        future = self.future
+        if future:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+
+class Scheduler:
+    """Runs delayed and periodic jobs, and one-off background work,
+    on a single timing thread and a shared pool of worker threads.
+    """
+
+    def __init__(self, workers: int = BACKGROUND_WORKERS):
+        """Create a new `Scheduler`.
+
+        :param workers: The amount of worker threads to run jobs on.
+        """
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="rasbot-worker")
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __push(self, job: Job):
+        with self._cond:
+            heapq.heappush(self._heap, (job.when, next(self._counter), job))
+
+            if not self._thread:
+                self._thread = threading.Thread(target=self.__run, daemon=True)
+                self._thread.start()
+
+            self._cond.notify()
+
+    def after(self, delay: float, func, *args) -> Job:
+        """Run `func(*args)` once after `delay` seconds.
+
+        :param delay: Time to wait before running, in seconds.
+        :param func: The function to run.
+        :return: The scheduled `Job`.
+        """
+        job = Job(time.monotonic() + delay, None, func, args)
+        self.__push(job)
+        return job
+
+    def every(self, interval: float, func, *args) -> Job:
+        """Run `func(*args)` every `interval` seconds, starting `interval` seconds from now.
+
+        A run is never started while the previous one is still going.
+
+        :param interval: Time between runs, in seconds.
+        :param func: The function to run.
+        :return: The scheduled `Job`.
+        """
+        job = Job(time.monotonic() + interval, interval, func, args)
+        self.__push(job)
+        return job
+
+    def submit(self, func, *args) -> Future:
+        """Run `func(*args)` on the worker pool as soon as possible.
+
+        :param func: The function to run.
+        :return: The `Future` for the result of `func`.
+        """
+        return self._pool.submit(func, *args)
+
+    def __run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+
+                when, _, job = self._heap[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+
+            if not job.cancelled:
+                job.future = self._pool.submit(self.__run_job, job)
+
+    def __run_job(self, job: Job):
+        try:
+            job.func(*job.args)
+        except Exception:
+            logging.error(f"background job {job.func} failed:")
+            logging.error(traceback.format_exc())
+        finally:
+            if job.interval and not job.cancelled:
+                job.when = max(job.when + job.interval, time.monotonic())
+                self.__push(job)
+
+
+scheduler = Scheduler()
+"""Shared `Scheduler` for every module."""
@@ -0,0 +1,197 @@
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+SAMPLE_SIZE = 1024
+"""Amount of most recent timings kept per metric to compute percentiles from."""
+
+QUANTILES = (0.5, 0.95, 0.99)
+"""Percentiles reported for every metric."""
+
+
+class Metric:
+    """Call count, error count, and recent latencies for one thing being measured."""
+
+    count: int
+    errors: int
+    total: float
+    """Total time spent, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, seconds: float, error: bool = False):
+        """Record one call.
+
+        :param seconds: How long the call took.
+        :param error: Whether the call failed.
+        """
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+        if error:
+            self.errors += 1
+
+    def quantiles(self) -> list[float]:
+        """Get the `QUANTILES` of the recent latencies, in seconds."""
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0 for _ in QUANTILES]
+
+        return [
+            samples[min(int(q * len(samples)), len(samples) - 1)] for q in QUANTILES
+        ]
+
+
+class Stats:
+    """Thread-safe registry of `Metric`s, keyed by kind (e.g. `command`, `main`, `on_pubmsg`, `http`), name, and channel.
+
+    Metrics not belonging to any one channel (e.g. `http`, as the API helpers are shared) have a channel of `None`.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def observe(
+        self,
+        kind: str,
+        name: str,
+        seconds: float,
+        error: bool = False,
+        channel: str = None,
+    ):
+        """Record one call of `name`.
+
+        :param kind: What sort of thing `name` is.
+        :param name: The command, module, or endpoint called.
+        :param seconds: How long the call took.
+        :param error: Whether the call failed.
+        :param channel: The channel the call was made for, or `None` if not for any one channel.
+        """
+        key = (kind, name, channel)
+        with self._lock:
+            metric = self._metrics.get(key, None)
+            if not metric:
+                metric = self._metrics[key] = Metric()
+
+            metric.observe(seconds, error)
+
+    @contextmanager
+    def timed(self, kind: str, name: str, channel: str = None):
+        """Record how long the body of the `with` takes, and whether it raises.
+
+        :param kind: What sort of thing `name` is.
+        :param name: The command, module, or endpoint called.
+        :param channel: The channel the call is made for, or `None` if not for any one channel.
+        """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, error, channel)
+
+    def snapshot(self, channels: list = None) -> dict:
+        """Get a summary of every metric.
+
+        :param channels: Only include metrics for these channels (`None` for ones not for any channel). Includes all if not given.
+        :return: A dict of `(kind, name, channel)` to (`count`, `errors`, `total`, [`p50`, `p95`, `p99`]).
+        """
+        with self._lock:
+            return {
+                key: (m.count, m.errors, m.total, m.quantiles())
+                for key, m in self._metrics.items()
+                if channels is None or key[2] in channels
+            }
+
+    def reset(self, channels: list = None):
+        """Forget metrics.
+
+        :param channels: Only forget metrics for these channels (`None` for ones not for any channel). Forgets all if not given.
+        """
+        with self._lock:
+            if channels is None:
+                self._metrics.clear()
+                return
+
+            for key in [k for k in self._metrics if k[2] in channels]:
+                del self._metrics[key]
+
+    def prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format.
+
+        :return: The metrics page.
+        """
+        lines = [
+            "# HELP rasbot_latency_seconds Time taken per call.",
+            "# TYPE rasbot_latency_seconds summary",
+        ]
+        errors = [
+            "# HELP rasbot_errors_total Calls that raised an error.",
+            "# TYPE rasbot_errors_total counter",
+        ]
+
+        for (kind, name, channel), (count, errs, total, quantiles) in sorted(
+            self.snapshot().items(), key=lambda i: (i[0][0], i[0][1], i[0][2] or "")
+        ):
+            labels = f'kind="{_escape(kind)}",name="{_escape(name)}"'
+            if channel:
+                labels += f',channel="{_escape(channel)}"'
+            for q, value in zip(QUANTILES, quantiles):
+                lines.append(
+                    f'rasbot_latency_seconds{{{labels},quantile="{q}"}} {value}'
+                )
+            lines.append(f"rasbot_latency_seconds_sum{{{labels}}} {total}")
+            lines.append(f"rasbot_latency_seconds_count{{{labels}}} {count}")
+            errors.append(f"rasbot_errors_total{{{labels}}} {errs}")
+
+        return "\n".join(lines + errors) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escape `value` for use as a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stats = Stats()
+"""Shared `Stats` for the whole process."""
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = stats.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics - {format % args}")
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """Serve `stats` at http://localhost:`port`/metrics on a background thread.
+
+    :param port: The port to listen on.
+    :return: The running server. Call `shutdown()` on it to stop it.
+    """
+    server = ThreadingHTTPServer(("localhost", port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    logging.info(f"Serving metrics at http://localhost:{port}/metrics")
+    return server
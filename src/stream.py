@@ -0,0 +1,127 @@
+import datetime
+import logging
+import threading
+import traceback
+
+from src.authentication import TwitchOAuth2Helper
+from src.scheduler import Job, scheduler
+
+MIN_POLL_INTERVAL = 30
+"""Time between checks right after the stream changed, in seconds."""
+
+MAX_POLL_INTERVAL = 240
+"""Longest time between checks while live and nothing is changing, in seconds."""
+
+MAX_OFFLINE_POLL_INTERVAL = 30
+"""Longest time between checks while offline, in seconds, so going live is noticed quickly."""
+
+
+class StreamState:
+    """Keeps track of whether a channel is live, and its' title and game, so modules can answer from memory.
+
+    Checks are spaced out further the longer nothing changes while live, and brought back in as soon as something does.
+    """
+
+    is_live: bool
+    started_at: datetime.datetime
+    """When the current stream started, in UTC, or `None` if not live."""
+    title: str
+    game: str
+    checked: bool
+    """Whether the stream has been checked at least once."""
+
+    def __init__(self, auth: TwitchOAuth2Helper, channel_id: int):
+        """Create a new `StreamState`. Call `start()` to start checking in the background.
+
+        :param auth: The Authentication object to use.
+        :param channel_id: The User ID of the channel to track.
+        """
+        self.auth = auth
+        self.channel_id = channel_id
+
+        self.is_live = False
+        self.started_at = None
+        self.title = None
+        self.game = None
+        self.checked = False
+
+        self._interval = MIN_POLL_INTERVAL
+        self._job: Job = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Check the stream now, and keep checking in the background until `stop()`."""
+        self._stopped = False
+        self._job = scheduler.after(0, self.__poll)
+
+    def stop(self):
+        """Stop checking the stream."""
+        self._stopped = True
+        if self._job:
+            self._job.cancel()
+
+    def refresh(self) -> bool:
+        """Check the stream now.
+
+        :return: Whether anything changed.
+        """
+        stream = self.auth.get_stream(self.channel_id)
+
+        with self._lock:
+            if not stream:
+                changed = self.is_live or not self.checked
+                self.is_live = False
+                self.started_at = None
+
+            else:
+                started_at = datetime.datetime.fromisoformat(stream["started_at"])
+                changed = (
+                    not self.is_live
+                    or started_at != self.started_at
+                    or stream["title"] != self.title
+                    or stream["game_name"] != self.game
+                )
+                self.is_live = True
+                self.started_at = started_at
+                self.title = stream["title"]
+                self.game = stream["game_name"]
+
+            self.checked = True
+
+        return changed
+
+    def uptime(self) -> datetime.timedelta | None:
+        """Get how long the channel has been live for.
+
+        :return: The time since the stream started, or `None` if not live.
+        """
+        if not self.checked:
+            self.refresh()
+
+        started_at = self.started_at
+        if not started_at:
+            return None
+
+        return datetime.datetime.now(datetime.timezone.utc) - started_at
+
+    def __poll(self):
+        try:
+            if self.refresh():
+                self._interval = MIN_POLL_INTERVAL
+            else:
+                self._interval = min(
+                    self._interval * 2,
+                    MAX_POLL_INTERVAL if self.is_live else MAX_OFFLINE_POLL_INTERVAL,
+                )
+
+        except Exception:
+            logging.error(f"failed to check stream for {self.channel_id}:")
+            logging.error(traceback.format_exc())
+            self._interval = (
+                MAX_POLL_INTERVAL if self.is_live else MAX_OFFLINE_POLL_INTERVAL
+            )
+
+        finally:
+            if not self._stopped:
+                self._job = scheduler.after(self._interval, self.__poll)
@@ -0,0 +1,69 @@
+import re
+
+TEMPLATE_KEY_RE = re.compile(r"%([\/a-z0-9_]+(?::[a-z0-9_]+)?)%")
+"""Regex for `%key%` mentions in templates, e.g. `%uptime%` or `%osu/request:stars%`."""
+
+
+def split_template(template: str) -> list[tuple[bool, str]]:
+    """Split `template` into literal text and `%key%` mentions.
+
+    :param template: The template to split.
+    :return: A list of `(is_key, value)` pairs, where `value` is either literal text or a key.
+    """
+    segments = []
+    last = 0
+    for match in TEMPLATE_KEY_RE.finditer(template):
+        if match.start() > last:
+            segments.append((False, template[last : match.start()]))
+        segments.append((True, match.group(1)))
+        last = match.end()
+
+    if last < len(template):
+        segments.append((False, template[last:]))
+
+    return segments
+
+
+class Template:
+    """A template with `%key%` fields, compiled once so rendering is a single join."""
+
+    template: str
+    parts: list
+    """Literal text, and functions taking the render context for each field."""
+    invalid: list[str]
+    """Keys in `template` that are not a known field. These are left in as-is."""
+
+    def __init__(self, template: str, fields: dict):
+        """Compile `template`.
+
+        :param template: The template text.
+        :param fields: A dict of field keys to functions that take the render context and return the value.
+        """
+        self.template = template
+        self.parts = []
+        self.invalid = []
+
+        for is_key, value in split_template(template):
+            if is_key:
+                if value in fields:
+                    self.parts.append(fields[value])
+                    continue
+
+                self.invalid.append(value)
+                value = f"%{value}%"
+
+            # merge neighbouring literals
+            if self.parts and isinstance(self.parts[-1], str):
+                self.parts[-1] += value
+            else:
+                self.parts.append(value)
+
+    def render(self, context) -> str:
+        """Fill in every field from `context`.
+
+        :param context: What to pass to each field function.
+        :return: The rendered text.
+        """
+        return "".join(
+            part if isinstance(part, str) else str(part(context)) for part in self.parts
+        )
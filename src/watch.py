@@ -0,0 +1,139 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+import threading
+import traceback
+
+from src.scheduler import Job, scheduler
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+"""inotify events that may mean a file in the watched folder changed."""
+
+POLL_INTERVAL = 1
+"""Time between checks when inotify isn't available, in seconds."""
+
+
+def _load_inotify():
+    """Get libc if it supports inotify, otherwise `None`."""
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """Calls `callback()` whenever a file's modification time or size changes.
+
+    Uses inotify on Linux, and checks every `poll_interval` seconds on the shared scheduler elsewhere.
+    """
+
+    path: str
+    poll_interval: float
+
+    def __init__(self, path: str, callback, poll_interval: float = POLL_INTERVAL):
+        """Create a new `FileWatcher`. Call `start()` to start watching.
+
+        :param path: The file to watch. Does not need to exist yet.
+        :param callback: Function taking no arguments to call when the file changes.
+        :param poll_interval: Time between checks when inotify isn't available, in seconds.
+        """
+        self.path = path
+        self.callback = callback
+        self.poll_interval = poll_interval
+
+        self._signature = self.__signature()
+        self._stopped = threading.Event()
+        self._job: Job = None
+
+    def __signature(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        """Call `callback()` if the file has changed since the last check."""
+        signature = self.__signature()
+        if signature == self._signature:
+            return
+
+        self._signature = signature
+        try:
+            self.callback()
+        except Exception:
+            logging.error(f"file watcher callback for {self.path} failed:")
+            logging.error(traceback.format_exc())
+
+    def start(self):
+        """Start watching the file in the background."""
+        fd = self.__inotify()
+        if fd is None:
+            logging.debug(f"polling {self.path} for changes")
+            self._job = scheduler.every(self.poll_interval, self.check)
+            return
+
+        logging.debug(f"watching {self.path} for changes with inotify")
+        threading.Thread(target=self.__watch, args=(fd,), daemon=True).start()
+
+    def stop(self):
+        """Stop watching the file."""
+        self._stopped.set()
+        if self._job:
+            self._job.cancel()
+
+    def __inotify(self) -> int | None:
+        """Set up an inotify watch on the file's folder.
+
+        Watching the folder rather than the file catches the file being replaced, or created later.
+
+        :return: The inotify file descriptor, or `None` if inotify isn't available.
+        """
+        libc = _load_inotify()
+        if not libc:
+            return None
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if libc.inotify_add_watch(fd, folder.encode(), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+
+        return fd
+
+    def __watch(self, fd: int):
+        try:
+            while not self._stopped.is_set():
+                # wake up every so often to see if we've been stopped
+                ready, _, _ = select.select([fd], [], [], 1)
+                if not ready:
+                    continue
+
+                # events are only a hint; the signature decides whether it changed
+                try:
+                    os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+
+                self.check()
+
+        finally:
+            os.close(fd)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.commands import CommandsHandler
+from src.plugins import ModulesHandler
+
+
+class FakeBot:
+    """Just enough of a `TwitchBot` to run commands, without connecting to Twitch."""
+
+    channel_id = 1
+    channel_name = "test"
+    prefix = "r!"
+
+    def __init__(self):
+        self.commands_handler = CommandsHandler(self)
+        self.modules_handler = ModulesHandler(self)
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    # run from a scratch folder so configs aren't written to the real userdata
+    (tmp_path / "modules").symlink_to(os.path.join(ROOT, "modules"))
+    monkeypatch.chdir(tmp_path)
+
+    bot = FakeBot()
+    yield bot
+
+    for name in bot.modules_handler.names():
+        bot.modules_handler.delete(name)
@@ -0,0 +1,60 @@
+import asyncio
+
+from src.definitions import Author, Message
+
+
+def message(text: str, author: Author = None) -> Message:
+    author = author or Author("viewer", "Viewer", "2")
+    return Message(author, text, None)
+
+
+def add_command(bot, name: str, response: str, cooldown: int = 0):
+    bot.commands_handler.add(
+        name,
+        {
+            "cooldown": cooldown,
+            "response": response,
+            "hidden": False,
+            "privilege": Author.Privilege.USER,
+        },
+    )
+
+
+def run(bot, msg: Message) -> str | None:
+    name, args = bot.commands_handler.parse(msg.text_raw)
+    msg.attach_command(name, args)
+    return asyncio.run(bot.commands_handler.run(name, msg))
+
+
+def test_runs_modules(bot):
+    add_command(bot, "hi", "hi %caller%, meet %target%")
+
+    assert run(bot, message("r!hi @someone")) == "hi viewer, meet someone"
+
+
+def test_unknown_command(bot):
+    assert run(bot, message("r!nothing")) is None
+
+
+def test_privilege(bot):
+    add_command(bot, "hi", "hi %caller%")
+    bot.commands_handler.modify("hi", "privilege", Author.Privilege.MOD)
+
+    assert run(bot, message("r!hi")) is None
+
+    mod = Author("mod", "Mod", "3", is_mod=True)
+    assert run(bot, message("r!hi", mod)) == "hi mod"
+
+
+def test_cooldown_claimed_before_modules_run(bot):
+    add_command(bot, "hi", "hi %caller%", cooldown=10)
+
+    async def both():
+        msgs = [message("r!hi"), message("r!hi")]
+        for msg in msgs:
+            msg.attach_command("hi", "")
+        return await asyncio.gather(
+            *(bot.commands_handler.run("hi", msg) for msg in msgs)
+        )
+
+    assert sorted(asyncio.run(both()), key=str) == [None, "hi viewer"]
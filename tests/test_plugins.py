@@ -0,0 +1,19 @@
+def test_reload_recreates_modules(bot):
+    bot.modules_handler.add("cmd", lazy=False)
+    old = bot.modules_handler.get("cmd")
+    old.cfg_set("default_cooldown", 1)
+
+    bot.modules_handler.reload()
+
+    new = bot.modules_handler.get("cmd")
+    assert new is not old
+    assert new.DEFAULT_COOLDOWN == 1
+
+
+def test_reload_keeps_lazy_modules_lazy(bot):
+    bot.modules_handler.add("caller")
+
+    bot.modules_handler.reload()
+
+    assert "caller" in bot.modules_handler.lazy
+    assert "caller" not in bot.modules_handler.modules